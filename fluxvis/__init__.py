@@ -4,12 +4,20 @@
 """Visualize floppy flux"""
 
 import csv
+import functools
+import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
 import numpy as np
-from skimage.color import gray2rgb
-from skimage.transform import downscale_local_mean
+from .greaseweazle.image.scp import SCP
 from .greaseweazle.tools.util import get_image_class
 from . import a2rchery
+from .fluxcache import CachedFlux, source_key
 from . import invpolar
+from .profiling import NULL_PROFILE
 
 PHYSICAL_TRACK = "Physical track"
 PHYSICAL_SIDE = "Physical side"
@@ -23,27 +31,67 @@ HEADER_COLOR = np.array((128, 128, 255), dtype=np.uint8)
 DATA_OK_COLOR = np.array((128, 255, 128), dtype=np.uint8)
 DATA_BAD_COLOR = np.array((255, 128, 128), dtype=np.uint8)
 
+# Decoder status is kept as an index into this palette until the final image
+BLANK, HEADER, DATA_OK, DATA_BAD = range(4)
+PALETTE = np.array(
+    ((255, 255, 255), HEADER_COLOR, DATA_OK_COLOR, DATA_BAD_COLOR), dtype=np.uint8
+)
+
+
+# A2R capture types, in order of preference; bits captures hold no timing
+A2R_TIMING, A2R_XTIMING = 1, 3
+
+
+def a2r_intervals(data):
+    """Decode the flux intervals of an A2R capture"""
+    # Each interval is a run of 255s ending in a smaller value, all summed
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data != 255)
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    return np.add.reduceat(data[: ends[-1] + 1], starts, dtype=np.uint32)
+
 
 class A2RTrackShim:
-    """Adapt an A2R file's track to act similar to a GreaseWeazle track"""
-
-    def __init__(self, flux, est_index):
-        self.index_list = [est_index]
-        self.list = []
-        append = self.list.append
-        subtotal = 0
-        for value in flux:
-            subtotal += value
-            if value < 255:
-                append(value)
-                subtotal = 0
+    """Adapt A2R captures of a track to act similar to a GreaseWeazle track
+
+    Each capture, given as its data and estimated loop point in ticks, is
+    split into the whole revolutions it holds, and the captures are joined
+    one after another so that their revolutions line up."""
+
+    def __init__(self, captures):
+        lists = []
+        self.index_list = []
+        carry = 0  # Ticks left over from the end of the last capture
+        for data, tick_count in captures:
+            intervals = a2r_intervals(data)
+            if len(intervals) == 0:
+                continue
+            times = np.cumsum(intervals, dtype=np.uint64)
+            tick_count = tick_count or int(times[-1])
+            revs = max(1, int(times[-1]) // tick_count)
+            keep = np.searchsorted(times, revs * tick_count, side="right")
+            if keep:
+                intervals = intervals[:keep]
+                intervals[0] += carry
+                carry = revs * tick_count - int(times[keep - 1])
+                lists.append(intervals)
+            else:
+                carry += revs * tick_count
+            self.index_list.extend([tick_count] * revs)
+        self.list = np.concatenate(lists) if lists else np.zeros(0, dtype=np.uint32)
 
     def cue_at_index(self):
         """No-operation needed for GW compatibility"""
 
 
 class A2RFluxShim:
-    """Adapt an A2R file to act similar to a GreaseWeazle flux file"""
+    """Adapt an A2R file to act similar to a GreaseWeazle flux file
+
+    A 3.5" disk's tracks are found by cylinder and side.  A 5.25" disk has
+    only one side, and is captured in quarter tracks, so its ``subtracks``
+    are 4 and its tracks are numbered in quarters of a cylinder."""
 
     @property
     def sample_freq(self):
@@ -52,13 +100,67 @@ class A2RFluxShim:
 
     def __init__(self, a2r):
         self._a2r = a2r
+        self.subtracks = 1 if a2r.info.get("disk_type") == 2 else 4
+
+    def location(self, track, side):
+        """The A2R location of a track, or None if there is no such track"""
+        if self.subtracks == 1:
+            return track * 2 + side
+        return track if side == 0 else None
+
+    def track_map(self):
+        """The tracks captured, as a sorted list of (track, side) pairs, found
+        from the locations in the file without decoding them"""
+        if self.subtracks == 1:
+            return sorted(divmod(location, 2) for location in self._a2r.flux)
+        return sorted((location, 0) for location in self._a2r.flux)
+
+    def has_track(self, track, side):
+        """Whether a track was captured"""
+        return self.location(track, side) in self._a2r.flux
 
     def get_track(self, track, side):
-        """Retrieve data about a track"""
-        if side == 0 and track in self._a2r.flux:
-            flux = self._a2r.flux[track][0]
-            return A2RTrackShim(flux["data"], flux["tick_count"])
-        return A2RTrackShim([1, 1, 1, 1], 4)
+        """Retrieve the timing captures of a track, preferring extended timing
+        captures, or None if it was not captured"""
+        location = self.location(track, side)
+        if location not in self._a2r.flux:
+            return None
+        captures = self._a2r.flux[location]
+        for capture_type in (A2R_XTIMING, A2R_TIMING):
+            best = [
+                (capture["data"], capture["tick_count"])
+                for capture in captures
+                if capture["capture_type"] == capture_type
+            ]
+            if best:
+                return A2RTrackShim(best)
+        return None
+
+
+class HFEFluxShim:
+    """Adapt an HFE file, which holds bitcells rather than flux, to act similar
+    to a GreaseWeazle flux file"""
+
+    def __init__(self, hfe):
+        self._hfe = hfe
+
+    @property
+    def sample_freq(self):
+        """The bitcell rate of the HFE file, in which its flux is measured"""
+        return 2000 * self._hfe.opts.bitrate
+
+    def track_map(self):
+        """The tracks present, as a sorted list of (cyl, side) pairs"""
+        return self._hfe.track_map()
+
+    def has_track(self, cyl, side):
+        """Whether a track is present"""
+        return self._hfe.has_track(cyl, side)
+
+    def get_track(self, cyl, side):
+        """Retrieve a track as flux, one tick per bitcell"""
+        track = self._hfe.get_track(cyl, side)
+        return None if track is None else track.flux()
 
 
 def a2r_to_flux(a2r):
@@ -66,116 +168,852 @@ def a2r_to_flux(a2r):
     return A2RFluxShim(a2r)
 
 
-def open_flux(filename):
-    """Open a flux file by filename"""
+def open_flux(filename, cache=None, key=None, data=None):
+    """Open a flux file by filename
+
+    If a ``FluxCache`` is given, decoded tracks are kept in it and served
+    from it when the file is opened again.  The flux is identified to caches
+    by ``key`` if given, or else by the file's path, size and modification
+    time.
+
+    An A2R file may instead be opened from its contents, given as ``data``,
+    in which case ``filename`` only gives its type and ``key`` is required."""
+    if data is not None and not filename.lower().endswith(".a2r"):
+        raise ValueError("Only A2R files can be opened from data")
+    if key is None:
+        if data is not None:
+            raise ValueError("A key is required to open flux from data")
+        key = source_key(filename)
     if filename.lower().endswith(".a2r"):
-        a2r = a2rchery.A2RReader(filename)
-        return a2r_to_flux(a2r)
+        # Map the file, or view the data, so captures are only copied when used
+        if data is not None:
+            a2r = a2rchery.A2RReader(data=data)
+        else:
+            a2r = a2rchery.A2RReader(filename, lazy=True)
+        flux = a2r_to_flux(a2r)
+        flux.source_key = key
+        return flux
     loader = get_image_class(filename)
-    return loader.from_file(filename)
+    if issubclass(loader, SCP):
+        # Map the image so that only the tracks being rendered are read
+        flux = loader.from_file(filename, lazy=True)
+    elif filename.lower().endswith(".hfe"):
+        flux = HFEFluxShim(loader.from_file(filename))
+    else:
+        flux = loader.from_file(filename)
+    if cache is not None:
+        flux = CachedFlux(flux, key, cache)
+    flux.source_key = key
+    return flux
 
 
-def render_flux(flux, side, tracks, start, stride, major, slices, stacks, location):
-    """Render flux to a linear image"""
-    density = np.zeros((major, slices), dtype=np.float32)
-    r = np.arange(slices)
+def find_tracks(flux, side, start, stride=None):
+    """Find how many cylinders to render, from ``start`` to the last present
+    on ``side``, and the stride between them if not given
+
+    The tracks present are listed without decoding them.  The stride found
+    is the largest which reaches every cylinder present, so that a 40 track
+    disk read in an 80 track drive shows no blank rows between its tracks.
+    Returns the count of cylinders and the stride."""
+    subtracks = getattr(flux, "subtracks", 1)
+    cyls = sorted(
+        {
+            number // subtracks
+            for number, number_side in flux.track_map()
+            if number_side == side and number // subtracks >= start
+        }
+    )
+    if not cyls:
+        raise ValueError(f"No tracks found on side {side}")
+    if stride is None:
+        stride = functools.reduce(math.gcd, (cyl - start for cyl in cyls)) or 1
+    return (cyls[-1] - start) // stride + 1, stride
 
+
+def flux_positions(track, slices):
+    """Cue a track at its index and find the angular position of each flux
+    transition, in slices
+
+    Returns the duration of the first revolution in sample ticks and the
+    (unfloored) positions; positions at or beyond ``slices`` belong to later
+    revolutions."""
+    track.cue_at_index()
+    if len(track.index_list) == 0:
+        index = np.sum(track.list)
+    else:
+        index = track.index_list[0]
+    # A Python float keeps the scaled flux below in float32
+    index = float(index)
+    positions = np.array(track.list, dtype=np.float32) * ((slices - 1) / index)
+    return index, np.add.accumulate(positions)
+
+
+def revolution_histogram(track, slices):
+    """Cue a track at its index and count the flux transitions in each slice
+    of every whole revolution
+
+    Each revolution is scaled by its own duration, so that the revolutions
+    line up despite any variation in rotational speed.  Returns the duration
+    of the first revolution in sample ticks and a (revolutions, slices) array
+    of counts."""
+    track.cue_at_index()
+    index = np.asarray(track.index_list, dtype=np.float64)
+    if len(index) == 0:
+        index = np.array([np.sum(track.list)], dtype=np.float64)
+    ends = np.cumsum(index)
+    times = np.cumsum(track.list, dtype=np.float64)
+    rev = np.searchsorted(ends, times)
+    keep = rev < len(index)
+    rev = rev[keep]
+    positions = (times[keep] - (ends - index)[rev]) * ((slices - 1) / index[rev])
+    bins = rev * slices + np.minimum(positions.astype(np.intp), slices - 1)
+    hist = np.bincount(bins, minlength=len(index) * slices)
+    return float(index[0]), hist.reshape(len(index), slices)
+
+
+def track_number(row, start, stride, subtracks=1):
+    """The number by which flux knows the track histogrammed on a row
+
+    The rows are cylinders ``start``, ``start + stride`` and so on, or if the
+    flux numbers its tracks in ``subtracks`` per cylinder, every subtrack of
+    each of those cylinders in turn."""
+    cyl, sub = divmod(row, subtracks)
+    return (cyl * stride + start) * subtracks + sub
+
+
+def histogram_tracks(
+    flux,
+    side,
+    cyls,
+    start,
+    stride,
+    slices,
+    counts,
+    prefetch=4,
+    revs="first",
+    profile=NULL_PROFILE,
+):
+    """Count the flux transitions in each slice of the given cylinders
+
+    Row ``cyl`` of ``counts`` receives the histogram of the first revolution
+    of that cylinder, or with ``revs`` of "mean" or "variance", that
+    statistic of the histograms of all its revolutions.  If the flux has
+    ``subtracks``, the rows are of those instead, as numbered by
+    ``track_number``.  Returns the duration of each row present, in sample
+    ticks.  Each track is recorded in ``profile``.
+
+    Tracks read ahead are cancelled if histogramming stops early."""
+    subtracks = getattr(flux, "subtracks", 1)
+    number = {cyl: track_number(cyl, start, stride, subtracks) for cyl in cyls}
+
+    # Formats which store each track separately can read them ahead
+    start_prefetch = getattr(flux, "prefetch", None)
+    if start_prefetch is not None and prefetch > 0:
+        start_prefetch([(number[cyl], side) for cyl in cyls], prefetch)
+
+    try:
+        return _histogram(flux, side, cyls, number, slices, counts, revs, profile)
+    finally:
+        # Formats which read ahead stop doing so
+        close = getattr(flux, "close", None)
+        if close is not None:
+            close()
+
+
+def _histogram(flux, side, cyls, number, slices, counts, revs, profile):
+    """Histogram cylinders for ``histogram_tracks``, reading the track of
+    each from its ``number``"""
     track_duration = {}
+    if revs != "first":
+        reduce = np.mean if revs == "mean" else np.var
+        for cyl in cyls:
+            with profile.track(number[cyl], side) as stage:
+                track = flux.get_track(number[cyl], side)
+                if track is None:
+                    continue
+                stage["flux"] = len(track.list)
+                track_duration[cyl], hist = revolution_histogram(track, slices)
+                counts[cyl] = reduce(hist, axis=0)
+        return track_duration
 
-    for cyl in range(0, tracks):
-        t0 = major - (1 + cyl) * stacks
-        t1 = major - cyl * stacks - 1
-        track = flux.get_track(cyl * stride + start, side)
-        if track is None:
-            continue
-        track.cue_at_index()
-        if not track.index_list:
-            index = sum(track.list)
+    # Gather the slice of every transition, offset by slices per track, so
+    # that a single bincount histograms all of the tracks at once
+    bins = []
+    for cyl in cyls:
+        with profile.track(number[cyl], side) as stage:
+            track = flux.get_track(number[cyl], side)
+            if track is None:
+                continue
+            stage["flux"] = len(track.list)
+            index, positions = flux_positions(track, slices)
+            track_duration[cyl] = index
+            positions = positions[positions < slices].astype(np.intp)
+            bins.append(positions + len(bins) * slices)
+
+    if bins:
+        hist = np.bincount(np.concatenate(bins), minlength=len(bins) * slices)
+        counts[list(track_duration)] = hist.reshape(len(bins), slices)
+
+    return track_duration
+
+
+_worker = {}
+
+
+def _init_worker(flux, shm_name, shape, kwargs):
+    """Attach a rendering process to the shared histogram array"""
+    shm = SharedMemory(name=shm_name)
+    _worker.update(
+        flux=flux,
+        shm=shm,
+        counts=np.ndarray(shape, dtype=np.float32, buffer=shm.buf),
+        kwargs=kwargs,
+    )
+
+
+def _histogram_worker(cyls):
+    """Histogram some cylinders in a worker process"""
+    return histogram_tracks(
+        _worker["flux"], cyls=cyls, counts=_worker["counts"], **_worker["kwargs"]
+    )
+
+
+def histogram_tracks_parallel(
+    flux, side, tracks, start, stride, slices, counts, prefetch, jobs, revs
+):
+    """Histogram all cylinders on a pool of processes
+
+    The workers write their rows straight into shared memory, and only the
+    track durations are sent back."""
+    kwargs = {
+        "side": side,
+        "start": start,
+        "stride": stride,
+        "slices": slices,
+        "prefetch": prefetch,
+        "revs": revs,
+    }
+    rows = len(counts)
+    chunk = max(1, -(-rows // (4 * jobs)))
+    chunks = [range(i, min(i + chunk, rows)) for i in range(0, rows, chunk)]
+    track_duration = {}
+    shm = SharedMemory(create=True, size=max(1, counts.nbytes))
+    try:
+        shared = np.ndarray(counts.shape, dtype=np.float32, buffer=shm.buf)
+        shared[:] = 0
+        with ProcessPoolExecutor(
+            jobs,
+            initializer=_init_worker,
+            initargs=(flux, shm.name, counts.shape, kwargs),
+        ) as pool:
+            for durations in pool.map(_histogram_worker, chunks):
+                track_duration.update(durations)
+        counts[:] = shared
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return track_duration
+
+
+def render_histograms(
+    flux,
+    side,
+    tracks,
+    start,
+    stride,
+    slices,
+    prefetch=4,
+    jobs=1,
+    revs="first",
+    profile=NULL_PROFILE,
+):
+    """Histogram every cylinder, on ``jobs`` processes
+
+    Returns a (tracks, slices) array of counts, or (tracks * subtracks,
+    slices) if the flux has ``subtracks``, and the duration of each row
+    present, in sample ticks."""
+    with profile.stage("histogram") as stage:
+        rows = tracks * getattr(flux, "subtracks", 1)
+        counts = np.zeros((rows, slices), dtype=np.float32)
+        if jobs > 1 and rows > 1:
+            track_duration = histogram_tracks_parallel(
+                flux, side, tracks, start, stride, slices, counts, prefetch, jobs, revs
+            )
         else:
-            index = track.index_list[0]
-        index = track.index_list[0]
-        track_duration[cyl] = index
-        indices = np.array(track.list, dtype=np.float32) * ((slices - 1) / index)
-        indices = np.floor(np.add.accumulate(indices))
-        lo = np.searchsorted(indices, r, "left")
-        hi = np.searchsorted(indices, r, "right")
-        density[t0:t1, :] = hi - lo
-
-    def ns2loc(offset_ns, cyl_duration):
-        return round(
-            offset_ns * flux.sample_freq / 1_000_000_000 / cyl_duration * (slices - 1)
+            track_duration = histogram_tracks(
+                flux,
+                side,
+                range(rows),
+                start,
+                stride,
+                slices,
+                counts,
+                prefetch,
+                revs,
+                profile,
+            )
+        stage["tracks"] = len(track_duration)
+    return counts, track_duration
+
+
+def track_band(cyl, major, stacks, gap=1, subtracks=1):
+    """The first and last (exclusive) rows of a linear image showing a
+    cylinder, or with ``subtracks``, a subtrack as numbered by histogram row
+
+    Each cylinder is ``stacks`` rows high, counting outward from the bottom
+    row, less ``gap`` rows left empty between cylinders.  Its subtracks
+    share the rest between them, as evenly as whole rows allow, with any
+    spare rows going to the first (the whole track)."""
+    cyl, sub = divmod(cyl, subtracks)
+    height = stacks - gap
+    end = major - cyl * stacks - gap
+    return (
+        end + -(sub + 1) * height // subtracks,
+        end + -sub * height // subtracks,
+    )
+
+
+def track_rows(cyls, major, stacks, gap=1, subtracks=1):
+    """Find the cylinder (or subtrack) shown on each row of a linear image,
+    laid out as by ``track_band``
+
+    Rows showing no cylinder are -1."""
+    rows = np.arange(major)
+    row_track = np.full(major, -1)
+    for cyl in sorted(cyls):
+        begin, end = track_band(cyl, major, stacks, gap, subtracks)
+        row_track[rows[begin:end]] = cyl
+    return row_track
+
+
+def _column(rows, header, name):
+    """Convert one column of a CSV file to float, with NaN for missing cells"""
+    if name not in header:
+        return np.full(len(rows), np.nan)
+    i = header.index(name)
+    return np.array(
+        [row[i] if i < len(row) and row[i] else "nan" for row in rows],
+        dtype=np.float64,
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _read_location(location, mtime_ns):
+    """Read a location CSV file; mtime_ns is only part of the cache key"""
+    with open(location, "r", encoding="utf-8", errors="ignore") as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        rows = list(reader)
+    columns = {
+        name: _column(rows, header, name)
+        for name in (
+            PHYSICAL_TRACK,
+            PHYSICAL_SIDE,
+            HEADER_START_NS,
+            HEADER_END_NS,
+            DATA_START_NS,
+            DATA_END_NS,
         )
+    }
+    status = np.zeros(len(rows), dtype=np.int8)  # -1 missing, 0 bad, 1 OK
+    if STATUS in header:
+        i = header.index(STATUS)
+        status[:] = [-1 if i >= len(row) else row[i] == "OK" for row in rows]
+    else:
+        status[:] = -1
+    columns[STATUS] = status
+    for column in columns.values():
+        column.flags.writeable = False
+    return columns
 
-    if location is not None:
 
-        def paint(t0, t1, start, end, color):
-            while start > slices:
-                start -= slices
-                end -= slices
-            status[t0 : t1 + 1, start:end] = color
-            if end > slices:
-                status[t0 : t1 + 1, : end % slices] = color
-
-        status = np.zeros((major, slices, 3), dtype=np.uint8) + 255
-        with open(location, "r", encoding="utf-8", errors="ignore") as f:
-            for row in csv.DictReader(f):
-                physical_track = row.get(PHYSICAL_TRACK)
-                physical_side = row.get(PHYSICAL_SIDE)
-                header_start = row.get(HEADER_START_NS)
-                header_end = row.get(HEADER_END_NS)
-                data_start = row.get(DATA_START_NS)
-                data_end = row.get(DATA_END_NS)
-                data_status = row.get(STATUS)
-
-                if any(x is None for x in (physical_track, physical_side, data_status)):
-                    continue
+def read_location(location):
+    """Read the columns of a fluxengine decoder location CSV file into arrays
 
-                physical_side = int(physical_side)
-                physical_track = int(physical_track)
-                if physical_side != side:
-                    continue
-                if physical_track % stride != start:
-                    continue
+    Empty and missing cells are NaN, and the status column holds 1 for OK,
+    0 for any other status and -1 where it is missing.  The result is cached
+    until the file is modified."""
+    return _read_location(location, os.stat(location).st_mtime_ns)
 
-                cyl = (physical_track - start) // stride
-                if cyl not in track_duration:
-                    continue
-                t0 = major - (1 + cyl) * stacks
-                t1 = major - cyl * stacks - 1
-
-                if header_start is not None and header_end is not None:
-                    header_start = ns2loc(float(header_start), track_duration[cyl])
-                    header_end = ns2loc(float(header_end), track_duration[cyl])
-                    if data_start is not None:  # artifically enlarge header mark
-                        header_end = ns2loc(float(data_start), track_duration[cyl])
-                    paint(t0, t1, header_start, header_end, HEADER_COLOR)
-
-                if data_start is not None and data_end is not None:
-                    data_start = ns2loc(float(data_start), track_duration[cyl])
-                    data_end = ns2loc(float(data_end), track_duration[cyl])
-                    paint(
-                        t0,
-                        t1,
-                        data_start,
-                        data_end,
-                        DATA_OK_COLOR if data_status == "OK" else DATA_BAD_COLOR,
-                    )
 
-        density = gray2rgb(density) * status
+def fill_spans(image, row, begin, end, value):
+    """Fill runs of pixels in the rows of an image, wrapping around from the
+    end of a row to its start
+
+    Runs are filled in order, so later runs overwrite earlier ones."""
+    width = image.shape[1]
+    # Move each run back whole turns until it begins within the row, then
+    # split it in two where it wraps around
+    turns = np.maximum(0, -(-(begin - width) // width))
+    begin = begin - turns * width
+    end = end - turns * width
+    wrap = np.where(end > width, end % width, 0)
+    row = np.repeat(row, 2)
+    value = np.repeat(value, 2)
+    begin = np.stack((np.maximum(begin, 0), np.zeros_like(begin)), axis=1).ravel()
+    end = np.stack((np.minimum(end, width), wrap), axis=1).ravel()
+
+    # Expand the runs to pixels, and find the last run to cover each pixel
+    length = np.maximum(end - begin, 0)
+    total = length.sum()
+    run = np.repeat(np.arange(len(length)), length)
+    pixel = np.arange(total) + (row * width + begin - np.cumsum(length) + length)[run]
+    last = np.full(image.size, -1, dtype=np.intp)
+    np.maximum.at(last, pixel, run)
+    painted = np.flatnonzero(last >= 0)
+    image.reshape(-1)[painted] = value[last[painted]]
+
+
+def render_status(
+    location, sample_freq, track_duration, side, start, stride, slices, subtracks=1
+):
+    """Paint the decoder status from a fluxengine CSV file for each cylinder
+
+    Returns an index into ``PALETTE`` for every slice of every histogram row,
+    ``BLANK`` where the decoder reported nothing.  With ``subtracks``, the
+    status of each cylinder is shown on its first subtrack."""
+    status = np.full((max(track_duration, default=-1) + 1, slices), BLANK, np.uint8)
+    columns = read_location(location)
+
+    physical_track = columns[PHYSICAL_TRACK]
+    physical_side = columns[PHYSICAL_SIDE]
+    data_status = columns[STATUS]
+    valid = ~np.isnan(physical_track) & ~np.isnan(physical_side) & (data_status >= 0)
+    valid &= physical_side == side
+    valid &= np.mod(physical_track, stride) == start
+    cyl = np.where(valid, (physical_track - start) // stride * subtracks, -1)
+    cyl = cyl.astype(np.intp)
+    present = np.zeros(len(status), dtype=bool)
+    present[list(track_duration)] = True
+    valid &= (cyl >= 0) & (cyl < len(status))
+    valid[valid] = present[cyl[valid]]
+    valid = np.flatnonzero(valid)
+    cyl = cyl[valid]
+    duration = np.array([track_duration[c] for c in cyl], dtype=np.float64)
+
+    def ns2loc(offset_ns):
+        return np.rint(
+            offset_ns[valid] * sample_freq / 1_000_000_000 / duration * (slices - 1)
+        )
+
+    header_start = ns2loc(columns[HEADER_START_NS])
+    header_end = ns2loc(columns[HEADER_END_NS])
+    data_start = ns2loc(columns[DATA_START_NS])
+    data_end = ns2loc(columns[DATA_END_NS])
+
+    # Artifically enlarge the header mark up to the data mark
+    has_header = ~np.isnan(header_start) & ~np.isnan(header_end)
+    header_end = np.where(np.isnan(data_start), header_end, data_start)
+    has_data = ~np.isnan(data_start) & ~np.isnan(data_end)
+
+    # Interleave the spans so that each row's header precedes its data
+    row = np.stack((cyl, cyl), axis=1)
+    begin = np.stack((header_start, data_start), axis=1)
+    end = np.stack((header_end, data_end), axis=1)
+    value = np.stack(
+        (
+            np.full(len(cyl), HEADER),
+            np.where(data_status[valid] == 1, DATA_OK, DATA_BAD),
+        ),
+        axis=1,
+    )
+    paint = np.stack((has_header, has_data), axis=1)
+    fill_spans(
+        status,
+        row[paint],
+        begin[paint].astype(np.intp),
+        end[paint].astype(np.intp),
+        value[paint].astype(np.uint8),
+    )
+    return status
+
+
+def status_image(
+    location,
+    sample_freq,
+    track_duration,
+    side,
+    start,
+    stride,
+    major,
+    slices,
+    stacks,
+    subtracks=1,
+):
+    """Paint the decoder status from a fluxengine CSV file as a linear image of
+    palette indices"""
+    status = np.full((major, slices), BLANK, dtype=np.uint8)
+    row_track = track_rows(track_duration, major, stacks, 0, subtracks)
+    filled = row_track >= 0
+    status[filled] = render_status(
+        location, sample_freq, track_duration, side, start, stride, slices, subtracks
+    )[row_track[filled]]
+    return status
+
+
+def scratch_array(shape, dtype, directory=None):
+    """Allocate a zeroed array backed by an anonymous temporary file in
+    ``directory``, so that it may be larger than memory"""
+    with tempfile.TemporaryFile(dir=directory) as f:
+        return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+
+def linear_density(counts, track_duration, major, stacks, density=None, subtracks=1):
+    """Lay out per-cylinder (or per-subtrack) slice histograms as a linear
+    density image, into ``density`` if given, which must be a zeroed float32
+    array"""
+    if density is None:
+        density = np.zeros((major, counts.shape[1]), dtype=np.float32)
+    row_track = track_rows(track_duration, major, stacks, subtracks=subtracks)
+    filled = row_track >= 0
+    density[filled] = counts[row_track[filled]]
     return density
 
 
-def circularize(density, resolution, oversample):
+def render_linear(
+    flux,
+    side,
+    tracks,
+    start,
+    stride,
+    major,
+    slices,
+    stacks,
+    location,
+    prefetch=4,
+    jobs=1,
+    revs="first",
+    density=None,
+    cache=None,
+    profile=NULL_PROFILE,
+):
+    """Render flux to a linear density image and, if ``location`` is given, a
+    linear image of decoder status palette indices (otherwise None)
+
+    The density is rendered into ``density`` if given, which must be a zeroed
+    (major, slices) float32 array.  If a ``DensityCache`` is given, the images
+    are served from it when this flux has been rendered with the same
+    parameters before, and added to it otherwise.  The stages are recorded in
+    ``profile``."""
+    key = getattr(flux, "source_key", None)
+    if cache is not None and key is not None:
+        key = cache.key(
+            key,
+            side,
+            tracks,
+            start,
+            stride,
+            major,
+            slices,
+            stacks,
+            revs,
+            location and source_key(location),
+        )
+        with profile.stage("load cached") as stage:
+            cached = cache.load(key, location is not None)
+            stage["hit"] = cached is not None
+        if cached is not None:
+            return cached
+    counts, track_duration = render_histograms(
+        flux, side, tracks, start, stride, slices, prefetch, jobs, revs, profile
+    )
+
+    subtracks = getattr(flux, "subtracks", 1)
+    with profile.stage("layout") as stage:
+        density = linear_density(
+            counts, track_duration, major, stacks, density, subtracks
+        )
+        stage["bytes"] = density.nbytes
+
+    status = None
+    if location is not None:
+        with profile.stage("status") as stage:
+            status = status_image(
+                location,
+                flux.sample_freq,
+                track_duration,
+                side,
+                start,
+                stride,
+                major,
+                slices,
+                stacks,
+                subtracks,
+            )
+            stage["bytes"] = status.nbytes
+    if cache is not None and key is not None:
+        with profile.stage("store cached"):
+            cache.store(key, density, status)
+    return density, status
+
+
+def render_flux(
+    flux,
+    side,
+    tracks,
+    start,
+    stride,
+    major,
+    slices,
+    stacks,
+    location,
+    prefetch=4,
+    jobs=1,
+    revs="first",
+):
+    """Render flux to a linear image"""
+    density, status = render_linear(
+        flux,
+        side,
+        tracks,
+        start,
+        stride,
+        major,
+        slices,
+        stacks,
+        location,
+        prefetch,
+        jobs,
+        revs,
+    )
+    if status is not None:
+        density = density[..., np.newaxis] * PALETTE[status]
+    return density
+
+
+def rasterize_polar(
+    counts, track_duration, major, stacks, resolution, antialias=True, subtracks=1
+):
+    """Rasterize per-cylinder slice histograms straight into a polar image
+
+    This produces the same geometry as warping the linear image made by
+    ``render_flux`` with ``circularize``, without either intermediate.  Each
+    histogram bin is split into samples no more than half an output pixel
+    apart, which are accumulated into the output pixels (spread over the
+    four nearest pixels by area if ``antialias``).  The totals are then
+    divided by the number of linear-image cells per output pixel at that
+    radius, giving flux per slice as in the warped image.  The last slice,
+    which falls on the first, is not drawn."""
+    slices = counts.shape[1]
+    size = resolution
+    center = size / 2 - 0.5
+    scale = (size / 2) / major  # output pixels per linear-image row
+    out = np.zeros(size * size, dtype=np.float32)
+
+    for cyl in sorted(track_duration):
+        # Rows of this cylinder's band, in linear-image row coordinates
+        begin, end = track_band(cyl, major, stacks, subtracks=subtracks)
+        r0 = max(begin, 0) - 0.5
+        r1 = end - 0.5
+        if r1 <= r0:
+            continue
+        # The last slice is at the same angle as the first, and only holds
+        # the start of the next revolution, so drawing it would repeat slice 0
+        bins = np.flatnonzero(counts[cyl, : slices - 1])
+        if len(bins) == 0:
+            continue
+        n_radial = max(1, int(np.ceil(2 * (r1 - r0) * scale)))
+        n_angular = max(1, int(np.ceil(4 * np.pi * r1 * scale / (slices - 1))))
+        radius = (r0 + (np.arange(n_radial) + 0.5) * (r1 - r0) / n_radial) * scale
+        offset = (np.arange(n_angular) + 0.5) / n_angular - 0.5
+        angle = (bins[:, np.newaxis] + offset).ravel() * (2 * np.pi / (slices - 1))
+        angle -= np.pi
+        weight = np.repeat(counts[cyl, bins], n_angular)
+        weight *= (r1 - r0) / (n_radial * n_angular)
+
+        yy = (center + np.outer(radius, np.cos(angle))).ravel()
+        xx = (center - np.outer(radius, np.sin(angle))).ravel()
+        weight = np.tile(weight, n_radial)
+
+        if antialias:
+            y0 = np.floor(yy)
+            x0 = np.floor(xx)
+            fy = yy - y0
+            fx = xx - x0
+            corners = (
+                (0, 0, (1 - fy) * (1 - fx)),
+                (0, 1, (1 - fy) * fx),
+                (1, 0, fy * (1 - fx)),
+                (1, 1, fy * fx),
+            )
+            y0 = y0.astype(np.intp)
+            x0 = x0.astype(np.intp)
+        else:
+            y0 = np.rint(yy).astype(np.intp)
+            x0 = np.rint(xx).astype(np.intp)
+            corners = ((0, 0, 1),)
+
+        pixel = []
+        value = []
+        for dy, dx, frac in corners:
+            y = y0 + dy
+            x = x0 + dx
+            inside = (y >= 0) & (y < size) & (x >= 0) & (x < size)
+            pixel.append(y[inside] * size + x[inside])
+            value.append((weight * frac)[inside])
+        pixel = np.concatenate(pixel)
+        value = np.concatenate(value)
+        out += np.bincount(pixel, value, size * size)
+
+    # Convert to flux per linear-image cell, a band of rows at a time
+    out = out.reshape(size, size)
+    yy = np.arange(size, dtype=np.float32)[np.newaxis, :] - center
+    band = max(1, (1 << 22) // size)
+    for i in range(0, size, band):
+        xx = np.arange(i, min(i + band, size), dtype=np.float32)[:, np.newaxis]
+        dist = np.maximum(np.hypot(xx - center, yy), 0.5)
+        out[i : i + band] *= dist * (2 * np.pi * scale / (slices - 1))
+    return out
+
+
+def render_polar(
+    flux,
+    side,
+    tracks,
+    start,
+    stride,
+    major,
+    slices,
+    stacks,
+    location,
+    resolution,
+    antialias=True,
+    prefetch=4,
+    jobs=1,
+    revs="first",
+    profile=NULL_PROFILE,
+):
+    """Render flux straight to a polar density image at the output resolution
+    and, if ``location`` is given, a polar image of decoder status palette
+    indices (otherwise None)"""
+    counts, track_duration = render_histograms(
+        flux, side, tracks, start, stride, slices, prefetch, jobs, revs, profile
+    )
+    subtracks = getattr(flux, "subtracks", 1)
+    with profile.stage("rasterize") as stage:
+        density = rasterize_polar(
+            counts, track_duration, major, stacks, resolution, antialias, subtracks
+        )
+        stage["bytes"] = density.nbytes
+    status = None
+    if location is not None:
+        with profile.stage("status") as stage:
+            status = invpolar.lookup_inverse_polar(
+                status_image(
+                    location,
+                    flux.sample_freq,
+                    track_duration,
+                    side,
+                    start,
+                    stride,
+                    major,
+                    slices,
+                    stacks,
+                    subtracks,
+                ),
+                output_shape=density.shape,
+            )
+            stage["bytes"] = status.nbytes
+    return density, status
+
+
+def circularize(density, resolution, oversample, profile=NULL_PROFILE):
     """Transform a linear density image to circular"""
     multichannel = len(density.shape) == 3
-    density = invpolar.warp_inverse_polar(
-        density,
-        output_shape=(resolution * oversample, resolution * oversample),
-        multichannel=multichannel,
+    with profile.stage("warp") as stage:
+        density = invpolar.warp_inverse_polar(
+            density,
+            output_shape=(resolution * oversample, resolution * oversample),
+            multichannel=multichannel,
+        )
+        stage["bytes"] = density.nbytes
+    with profile.stage("downscale") as stage:
+        from skimage.transform import downscale_local_mean
+
+        if multichannel:
+            density = downscale_local_mean(density, (oversample, oversample, 1))
+        else:
+            density = downscale_local_mean(density, (oversample, oversample))
+        stage["bytes"] = density.nbytes
+    return density
+
+
+def shade(density, out=None):
+    """Scale a density image to 8 bits, so that the densest pixel is 255
+
+    The image is scaled a band of rows at a time, into ``out`` if given."""
+    band = max(1, (1 << 20) // density.shape[1])
+    # A blank image, such as the variance of single revolutions, stays black
+    maxdensity = np.max(density) or 1
+    if out is None:
+        out = np.empty(density.shape, dtype=np.uint8)
+    for i in range(0, len(density), band):
+        out[i : i + band] = density[i : i + band] * (255 / maxdensity)
+    return out
+
+
+def colorize(density, status, out=None):
+    """Compose an 8-bit RGB image from density and status palette index images,
+    scaled so that the brightest channel of the brightest pixel is 255
+
+    The image is composed a band of rows at a time, into ``out`` if given,
+    so no full-size floating point RGB image is needed."""
+    band = max(1, (1 << 20) // density.shape[1])
+    peak = PALETTE.max(axis=1)
+    maxdensity = max(
+        np.max(density[i : i + band] * peak[status[i : i + band]])
+        for i in range(0, len(density), band)
     )
-    if multichannel:
-        return downscale_local_mean(density, (oversample, oversample, 1))
-    return downscale_local_mean(density, (oversample, oversample))
+    maxdensity = maxdensity or 1
+    if out is None:
+        out = np.empty((*density.shape, 3), dtype=np.uint8)
+    for i in range(0, len(density), band):
+        color = density[i : i + band, :, np.newaxis] * PALETTE[status[i : i + band]]
+        out[i : i + band] = color * (255 / maxdensity)
+    return out
+
+
+def finish_tiled(
+    density,
+    status,
+    linear,
+    resolution,
+    oversample,
+    tile,
+    scratch,
+    profile=NULL_PROFILE,
+):
+    """Turn a linear density image into the final 8-bit image out of core
+
+    Polar images are warped a tile at a time into a scratch file, and the
+    result is another scratch file, so neither needs to fit in memory."""
+    if not linear:
+        with profile.stage("warp") as stage:
+            polar = scratch_array((resolution, resolution), np.float32, scratch)
+            for row, col, pixels in invpolar.iter_inverse_polar_tiles(
+                density, output_shape=polar.shape, tile=tile, oversample=oversample
+            ):
+                polar[row : row + len(pixels), col : col + pixels.shape[1]] = pixels
+            density = polar
+            stage["bytes"] = polar.nbytes
+        if status is not None:
+            with profile.stage("status warp") as stage:
+                status = invpolar.lookup_inverse_polar(
+                    status,
+                    output_shape=polar.shape,
+                    out=scratch_array(polar.shape, np.uint8, scratch),
+                )
+                stage["bytes"] = status.nbytes
+
+    with profile.stage("normalize") as stage:
+        if status is not None:
+            out = scratch_array((*density.shape, 3), np.uint8, scratch)
+            out = colorize(density, status, out)
+        else:
+            out = shade(density, scratch_array(density.shape, np.uint8, scratch))
+        stage["bytes"] = out.nbytes
+    return out
 
 
 def process(
@@ -191,20 +1029,109 @@ def process(
     diameter,
     resolution,
     oversample,
+    prefetch=4,
+    jobs=1,
+    direct=False,
+    antialias=True,
+    revs="first",
+    tile=0,
+    scratch=None,
+    density_cache=None,
+    profile=NULL_PROFILE,
 ):
-    """Process flux into an image"""
+    """Process flux into an image
+
+    If ``tile`` is nonzero, the linear and final images are kept in
+    temporary files in the ``scratch`` directory, and polar images are warped
+    in tiles of that size, so that the image need not fit in memory; the
+    result is then a ``np.memmap``.  This does not apply with ``direct``.
+
+    If a ``DensityCache`` is given, the linear images are kept in it, so that
+    processing the same flux again with only ``linear``, ``diameter`` (for
+    linear images), ``resolution``, ``oversample`` or ``tile`` changed
+    only needs to project and shade them.
+
+    Each stage, and each track, is recorded in ``profile`` if it is a
+    ``Profile``.
+
+    If ``tracks`` or ``stride`` is None, it is found from the tracks present
+    with ``find_tracks``."""
+
+    if tracks is None or stride is None:
+        found, stride = find_tracks(flux, side, start, stride)
+        tracks = found if tracks is None else tracks
 
     if linear:
         major = round(tracks * stacks)
     else:
         major = round(diameter * stacks / 2)
 
-    density = render_flux(
-        flux, side, tracks, start, stride, major, slices, stacks, location
-    )
-
-    if not linear:
-        density = circularize(density, resolution, oversample)
+    if direct and not linear:
+        density, status = render_polar(
+            flux,
+            side,
+            tracks,
+            start,
+            stride,
+            major,
+            slices,
+            stacks,
+            location,
+            resolution,
+            antialias,
+            prefetch,
+            jobs,
+            revs,
+            profile,
+        )
+    elif tile:
+        density, status = render_linear(
+            flux,
+            side,
+            tracks,
+            start,
+            stride,
+            major,
+            slices,
+            stacks,
+            location,
+            prefetch,
+            jobs,
+            revs,
+            scratch_array((major, slices), np.float32, scratch),
+            cache=density_cache,
+            profile=profile,
+        )
+        return finish_tiled(
+            density, status, linear, resolution, oversample, tile, scratch, profile
+        )
+    else:
+        density, status = render_linear(
+            flux,
+            side,
+            tracks,
+            start,
+            stride,
+            major,
+            slices,
+            stacks,
+            location,
+            prefetch,
+            jobs,
+            revs,
+            cache=density_cache,
+            profile=profile,
+        )
+        if not linear:
+            density = circularize(density, resolution, oversample, profile)
+            if status is not None:
+                with profile.stage("status warp") as stage:
+                    status = invpolar.lookup_inverse_polar(
+                        status, output_shape=density.shape
+                    )
+                    stage["bytes"] = status.nbytes
 
-    maxdensity = np.max(density)
-    return (density * (255 / maxdensity)).astype(np.uint8)
+    with profile.stage("normalize") as stage:
+        out = shade(density) if status is None else colorize(density, status)
+        stage["bytes"] = out.nbytes
+    return out
@@ -4,10 +4,17 @@
 
 """Flux visualizer"""
 
+import json
+import os
+
 import click
-from skimage.io import imsave
-import matplotlib.pyplot as plt
-from . import open_flux, process
+from . import find_tracks, open_flux, process, render_histograms
+from .batch import batch_inputs, render_batch
+from .bench import GENERATORS, run_benchmarks
+from .deepzoom import write_deepzoom
+from .fluxcache import DensityCache, FluxCache
+from .profiling import NULL_PROFILE, Profile
+from .writer import write_image
 
 
 @click.group()
@@ -25,8 +32,19 @@ from . import open_flux, process
     'A 5.25" HD disk is approximately 216, 3.5" HD disk is approximately 420. '
     "Halve for DD. (default: 216)",
 )
-@click.option("--tracks", default=80, help="The total count of tracks (default: 80)")
-@click.option("--stride", default=1, help="Stride between tracks (default: 1)")
+@click.option(
+    "--tracks",
+    default=None,
+    type=int,
+    help="The total count of tracks (default: up to the last in the file)",
+)
+@click.option(
+    "--stride",
+    default=None,
+    type=int,
+    help="Stride between tracks (default: the largest reaching every track in "
+    "the file)",
+)
 @click.option("--start", default=0, help="Number of the first tracks (default: 0)")
 @click.option("--side", default=0, help="Side of floppy (default: 0)")
 @click.option(
@@ -36,12 +54,86 @@ from . import open_flux, process
 @click.option(
     "--oversample", default=2, help="Increase oversampling of polar transformation"
 )
+@click.option(
+    "--direct/--warp",
+    default=False,
+    help="Rasterize polar images straight at the output resolution instead of "
+    "warping a linear image, which needs much less memory for large "
+    "resolutions (default: warp)",
+)
+@click.option(
+    "--antialias/--no-antialias",
+    default=True,
+    help="Spread flux over neighboring pixels with --direct (default: antialias)",
+)
+@click.option(
+    "--revs",
+    default="first",
+    type=click.Choice(["first", "mean", "variance"]),
+    help="Show the first revolution of each track, or the mean or variance of "
+    "all its revolutions (default: first)",
+)
+@click.option(
+    "--tile",
+    default=0,
+    help="Render out of core, warping polar images in tiles of this many "
+    "pixels, or 0 to render in memory (default: 0)",
+)
+@click.option(
+    "--scratch",
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+    help="Directory for the temporary files of --tile (default: system temp)",
+)
 @click.option(
     "--location",
     default=None,
     type=click.Path(exists=True),
     help="fluxengine decoder location information saved with --decoder.write_csv_to=",
 )
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Keep decoded flux and linear images in a cache directory, so that "
+    "rendering the same file again skips decoding it, and rendering it with "
+    "only the image size or style changed skips rendering tracks (default: cache)",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="Directory for the cache (default: ~/.cache/fluxvis)",
+)
+@click.option(
+    "--cache-size",
+    default=1024,
+    help="Size limit of the cache in MiB (default: 1024)",
+)
+@click.option(
+    "--profile",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Record the time and memory taken by each stage and track of view "
+    "and write in this file",
+)
+@click.option(
+    "--profile-format",
+    default="json",
+    type=click.Choice(["json", "chrome"]),
+    help="Format of the --profile file, JSON or a Chrome trace that "
+    "chrome://tracing or Perfetto can show (default: json)",
+)
+@click.option(
+    "--prefetch",
+    default=4,
+    help="Number of threads reading flux files ahead of rendering, "
+    "or 0 to read each track as it is rendered (default: 4)",
+)
+@click.option(
+    "--jobs",
+    default=1,
+    help="Number of processes rendering tracks in parallel (default: 1)",
+)
 def main(
     ctx,
     side,
@@ -55,9 +147,29 @@ def main(
     resolution,
     linear,
     oversample,
+    cache,
+    cache_dir,
+    cache_size,
+    direct,
+    antialias,
+    revs,
+    tile,
+    scratch,
+    profile,
+    profile_format,
+    prefetch,
+    jobs,
 ):
     """Commandline interface to visualize flux"""
     ctx.ensure_object(dict)
+    ctx.meta["profile"] = Profile() if profile else NULL_PROFILE
+    ctx.meta["profile_file"] = profile
+    ctx.meta["profile_format"] = profile_format
+    ctx.meta["cache"] = FluxCache(cache_dir, cache_size << 20) if cache else None
+    # A linear image is only used once per run, so it is not kept in memory
+    ctx.meta["density_cache"] = (
+        DensityCache(ctx.meta["cache"], entries=0) if cache else None
+    )
     ctx.obj.update(
         {
             "side": side,
@@ -71,10 +183,53 @@ def main(
             "diameter": diameter,
             "resolution": resolution,
             "oversample": oversample,
+            "prefetch": prefetch,
+            "jobs": jobs,
+            "direct": direct,
+            "antialias": antialias,
+            "revs": revs,
+            "tile": tile,
+            "scratch": scratch,
         }
     )
 
 
+def track_options(ctx, flux):
+    """The command line options, with --tracks and --stride found from the
+    flux if they were not given"""
+    options = ctx.obj
+    if options["tracks"] is None or options["stride"] is None:
+        try:
+            tracks, stride = find_tracks(
+                flux, options["side"], options["start"], options["stride"]
+            )
+        except ValueError as e:
+            raise click.UsageError(str(e)) from e
+        if options["tracks"] is not None:
+            tracks = options["tracks"]
+        options = dict(options, tracks=tracks, stride=stride)
+    return options
+
+
+def render(ctx, input_file):
+    """Open and process a flux file with the command line options"""
+    profile = ctx.meta["profile"]
+    with profile.stage("open"):
+        flux = open_flux(input_file, ctx.meta["cache"])
+    return process(
+        flux,
+        density_cache=ctx.meta["density_cache"],
+        profile=profile,
+        **track_options(ctx, flux),
+    )
+
+
+def save_profile(ctx):
+    """Write the --profile file, if one was given"""
+    if ctx.meta["profile_file"] is not None:
+        ctx.meta["profile"].write(ctx.meta["profile_file"], ctx.meta["profile_format"])
+
+
 @main.command()
 @click.pass_context
 @click.argument("input_file", type=click.Path(exists=True))
@@ -83,8 +238,11 @@ def view(ctx, input_file):
 
     INPUT_FILE may be any flux format recognized by the embedded copy of
     greaseweazle (.scp, etc) or an a2r file."""
-    flux = open_flux(input_file)
-    density = process(flux, **ctx.obj)
+    # pyplot takes longer to import than most renders, so only view loads it
+    import matplotlib.pyplot as plt
+
+    density = render(ctx, input_file)
+    save_profile(ctx)
 
     fig, axis = plt.subplots()
     fig.set_dpi(96)
@@ -107,10 +265,164 @@ def write(ctx, input_file, output_file):
     greaseweazle (.scp, etc) or an a2r file.
 
     OUTPUT_FILE may be any image format recognized by scikit_img including PNG,
-    GIF, and JPG"""
-    flux = open_flux(input_file)
-    density = process(flux, **ctx.obj)
-    imsave(output_file, density)
+    GIF, and JPG.  PNG and TIFF files are written a band of rows at a time,
+    and very large TIFF files are written as BigTIFF."""
+    density = render(ctx, input_file)
+    with ctx.meta["profile"].stage("encode") as stage:
+        write_image(output_file, density)
+        stage["bytes"] = os.path.getsize(output_file)
+    save_profile(ctx)
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "--tile-size", default=256, help="Size of the square tiles (default: 256)"
+)
+@click.argument("input_file", type=click.Path(exists=True))
+@click.argument("output_file", type=click.Path())
+def tiles(ctx, tile_size, input_file, output_file):
+    """Render a polar flux image as a DeepZoom tile pyramid
+
+    INPUT_FILE may be any flux format recognized by the embedded copy of
+    greaseweazle (.scp, etc) or an a2r file.
+
+    OUTPUT_FILE is the .dzi file to write.  The PNG tiles are written to a
+    directory next to it, named like it with "_files" in place of ".dzi".
+    The --resolution is the size of the largest level."""
+    options = ctx.obj
+    if options["location"] is not None:
+        raise click.UsageError("--location is not supported with tiles")
+    flux = open_flux(input_file, ctx.meta["cache"])
+    options = track_options(ctx, flux)
+    counts, track_duration = render_histograms(
+        flux,
+        options["side"],
+        options["tracks"],
+        options["start"],
+        options["stride"],
+        options["slices"],
+        options["prefetch"],
+        options["jobs"],
+        options["revs"],
+    )
+    write_deepzoom(
+        counts,
+        track_duration,
+        output_file,
+        diameter=options["diameter"],
+        slices=options["slices"],
+        stacks=options["stacks"],
+        resolution=options["resolution"],
+        oversample=options["oversample"],
+        tile_size=tile_size,
+        subtracks=getattr(flux, "subtracks", 1),
+        scratch=options["scratch"],
+    )
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "--workers",
+    default=0,
+    help="Number of processes rendering files, or 0 for one per CPU (default: 0)",
+)
+@click.argument("source")
+@click.argument("output_template")
+def batch(ctx, workers, source, output_template):
+    """Render many flux files to image files
+
+    SOURCE may be a directory of flux files (and KryoFlux stream
+    directories), a quoted glob pattern, or a manifest file listing one input
+    per line.
+
+    OUTPUT_TEMPLATE names the image file for each input, and may use the
+    input's {name}, its {stem} without extension, and its {parent}
+    directory name, e.g. "images/{stem}.png".
+
+    Files which cannot be rendered are reported, and the rest are still
+    rendered."""
+    try:
+        inputs = batch_inputs(source)
+    except ValueError as e:
+        raise click.UsageError(str(e)) from e
+    if not inputs:
+        raise click.UsageError(f"No flux files found in {source}")
+    failures = 0
+    try:
+        for path, output, error in render_batch(
+            inputs,
+            output_template,
+            ctx.obj,
+            workers,
+            ctx.meta["cache"],
+            ctx.meta["density_cache"],
+        ):
+            if error is None:
+                click.echo(f"{path} -> {output}")
+            else:
+                failures += 1
+                click.echo(f"{path}: {error}", err=True)
+    except ValueError as e:
+        raise click.UsageError(str(e)) from e
+    if failures:
+        click.echo(f"{failures} of {len(inputs)} files failed", err=True)
+        ctx.exit(1)
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "--format",
+    "formats",
+    multiple=True,
+    type=click.Choice(list(GENERATORS)),
+    help="Format of synthetic image to render, may be repeated (default: all)",
+)
+@click.option("--revolutions", default=2, help="Revolutions of each track (default: 2)")
+@click.option(
+    "--bitrate", default=250, help="Data rate of the tracks in kbit/s (default: 250)"
+)
+@click.option("--rpm", default=300, help="Rotational speed (default: 300)")
+@click.option(
+    "--jitter",
+    default=0.02,
+    help="Standard deviation of flux intervals, as a fraction of each "
+    "(default: 0.02)",
+)
+@click.option(
+    "--repeat", default=3, help="Take the best of this many runs (default: 3)"
+)
+@click.option(
+    "--startup/--no-startup",
+    default=True,
+    help="Also time starting up in a fresh interpreter (default: startup)",
+)
+@click.option(
+    "--output",
+    default="-",
+    type=click.File("w"),
+    help="File to write the results to (default: standard output)",
+)
+def bench(ctx, formats, revolutions, bitrate, rpm, jitter, repeat, startup, output):
+    """Time rendering synthetic flux images
+
+    Images of --tracks tracks (80 unless given) are generated in a temporary
+    directory in each format, then rendered with the other options given
+    before "bench".  The time taken by each stage is written as JSON."""
+    results = run_benchmarks(
+        ctx.obj,
+        formats or tuple(GENERATORS),
+        revolutions,
+        bitrate,
+        rpm,
+        jitter,
+        repeat,
+        startup,
+    )
+    json.dump(results, output, indent=2)
+    output.write("\n")
 
 
 if __name__ == "__main__":
@@ -9,7 +9,9 @@
 
 import argparse
 import collections
+import collections.abc
 import json
+import mmap
 import os
 import sys
 
@@ -143,12 +145,44 @@ class A2RValidator:
     def validate_metadata_requires_machine(self, requires_machine):
         raise_if(requires_machine and (requires_machine not in kRequiresMachine), A2RMETAFormatError_BadMachine, "Invalid metadata requires_machine")
 
+class A2RLazyFlux(collections.abc.Mapping):
+    """captures by location, like A2RReader.flux, but made on demand from an index of (location, capture_type, offset, length, tick_count) entries, with each capture's data a zero-copy view of the buffer"""
+    def __init__(self, view, index):
+        self.view = view
+        self.index = collections.OrderedDict()
+        for entry in index:
+            self.index.setdefault(entry[0], []).append(entry)
+
+    def __getitem__(self, location):
+        return [{"capture_type": capture_type,
+                 "data_length": length,
+                 "tick_count": tick_count,
+                 "data": self.view[offset:offset+length]}
+                for _, capture_type, offset, length, tick_count in self.index[location]]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
 class A2RReader(DiskImage, A2RValidator):
-    def __init__(self, filename=None, stream=None):
-        DiskImage.__init__(self, filename, stream)
+    def __init__(self, filename=None, stream=None, lazy=False, data=None):
+        """if lazy, the file is mapped into memory rather than read, and only an index of its captures is made; data may instead give the contents of a file as a bytes-like object, which is read lazily"""
+        DiskImage.__init__(self, filename, stream if data is None else data)
         self.info = collections.OrderedDict()
         self.meta = collections.OrderedDict()
         self.flux = collections.OrderedDict()
+        self.index = []
+        self.lazy = lazy or data is not None
+
+        if self.lazy:
+            if data is None:
+                with open(filename, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = data
+            self.__read_lazy(memoryview(data).cast("B"))
+            return
 
         with stream or open(filename, "rb") as f:
             header_raw = f.read(8)
@@ -171,6 +205,46 @@ class A2RReader(DiskImage, A2RValidator):
                 elif chunk_id == kMETA:
                     self.__process_meta(data)
 
+    def __read_lazy(self, view):
+        raise_if(len(view) < 8, A2REOFError, sEOF)
+        self.__process_header(bytes(view[:8]))
+        i = 8
+        while i < len(view):
+            raise_if(len(view) - i < 8, A2REOFError, sEOF)
+            chunk_id = bytes(view[i:i+4])
+            chunk_size = from_uint32(view[i+4:i+8])
+            i += 8
+            raise_if(len(view) - i < chunk_size, A2REOFError, sEOF)
+            if chunk_id == kINFO:
+                raise_if(chunk_size != 36, A2RFormatError, sBadChunkSize)
+                self.__process_info(bytes(view[i:i+chunk_size]))
+            elif chunk_id == kSTRM:
+                self.__index_strm(view, i, chunk_size)
+            elif chunk_id == kMETA:
+                self.__process_meta(bytes(view[i:i+chunk_size]))
+            i += chunk_size
+        self.flux = A2RLazyFlux(view, self.index)
+
+    def __index_strm(self, view, start, size):
+        end = start + size
+        raise_if(view[end-1] != 0xFF, A2RSTRMFormatError, "Missing phase reset at end of STRM chunk")
+        i = start
+        while i < end - 1:
+            location = view[i]
+            capture_type = view[i+1]
+            data_length = from_uint32(view[i+2:i+6])
+            tick_count = from_uint32(view[i+6:i+10])
+            self.index.append((location, capture_type, i+10, data_length, tick_count))
+            i = i + 10 + data_length
+
+    def __reduce_ex__(self, protocol):
+        # A memory-mapped file cannot be pickled: map it again instead.
+        if self.lazy and isinstance(self.data, mmap.mmap):
+            return (type(self), (self.filename, None, True))
+        if self.lazy:
+            return (type(self), (None, None, True, bytes(self.data)))
+        return super().__reduce_ex__(protocol)
+
     def __process_header(self, data):
         raise_if(data[:4] != kA2R2, A2RHeaderError_NoA2R2, "Magic string 'A2R2' not present at offset 0")
         raise_if(data[4] != 0xFF, A2RHeaderError_NoFF, "Magic byte 0xFF not present at offset 4")
@@ -0,0 +1,146 @@
+# SPDX-FileCopyrightText: 2022 Jeff Epler for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""Render many flux files on a pool of processes"""
+
+import glob
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from . import open_flux, process
+from .writer import write_image
+
+# Flux files which may be found in a directory of inputs; KryoFlux streams
+# are directories of .raw files
+FLUX_SUFFIXES = (".a2r", ".hfe", ".scp")
+
+# Manifests, listing one input per line
+MANIFEST_SUFFIXES = (".txt", ".lst")
+
+
+def is_kryoflux(path):
+    """Whether a path is a directory of KryoFlux stream files"""
+    return os.path.isdir(path) and any(
+        name.lower().endswith(".raw") for name in os.listdir(path)
+    )
+
+
+def batch_inputs(source):
+    """List the flux files named by ``source``
+
+    This may be a single flux file or KryoFlux stream file, a directory
+    holding flux files (and KryoFlux stream directories), a glob pattern, or
+    a manifest file listing one input per line, relative to the manifest's
+    directory.  Blank lines and lines starting with "#" in a manifest are
+    ignored.  A manifest is a text file named like ``MANIFEST_SUFFIXES``, or
+    any other file which is valid UTF-8."""
+    if os.path.isdir(source) and not is_kryoflux(source):
+        return [
+            path
+            for path in sorted(
+                os.path.join(source, name) for name in os.listdir(source)
+            )
+            if path.lower().endswith(FLUX_SUFFIXES) or is_kryoflux(path)
+        ]
+    if glob.has_magic(source):
+        return sorted(glob.glob(source))
+    if os.path.isdir(source) or source.lower().endswith(FLUX_SUFFIXES + (".raw",)):
+        return [source]
+    if not os.path.isfile(source):
+        raise ValueError(f"No such file or directory: {source}")
+    base = os.path.dirname(source)
+    try:
+        with open(source, "r", encoding="utf-8") as f:
+            lines = [line.strip() for line in f]
+    except UnicodeDecodeError as e:
+        if source.lower().endswith(MANIFEST_SUFFIXES):
+            raise ValueError(f"Manifest {source} is not UTF-8 text") from e
+        raise ValueError(f"{source} is neither a flux file nor a manifest") from e
+    return [os.path.join(base, line) for line in lines if line and line[0] != "#"]
+
+
+def output_name(template, path):
+    """Fill in an output filename template for an input
+
+    The template may refer to the input's {name}, its {stem} (the name
+    without extension) and the {parent} directory name."""
+    path = os.path.normpath(path)
+    name = os.path.basename(path)
+    return template.format(
+        name=name,
+        stem=os.path.splitext(name)[0],
+        parent=os.path.basename(os.path.dirname(os.path.abspath(path))),
+    )
+
+
+def _read_ahead(path):
+    """Read a flux file (or directory) so that it will be in the page cache"""
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    for name in paths:
+        try:
+            with open(name, "rb") as f:
+                while f.read(1 << 20):
+                    pass
+        except OSError:
+            pass
+
+
+def render_one(path, output, options, cache=None, density_cache=None):
+    """Render one flux file to an image file"""
+    flux = open_flux(path, cache)
+    density = process(flux, density_cache=density_cache, **options)
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    write_image(output, density)
+
+
+def render_batch(
+    inputs, template, options, workers=None, cache=None, density_cache=None
+):
+    """Render flux files to images on a pool of ``workers`` processes
+
+    Each process renders many files, reusing the cached warp geometry.  Only
+    one file per process is submitted at a time, and the file that will be
+    submitted next is read ahead while they work.  Yields each input, its
+    output, and the exception raised rendering it (or None) as they
+    finish."""
+    try:
+        outputs = [output_name(template, path) for path in inputs]
+    except KeyError as e:
+        raise ValueError(f"Unknown field {e} in output template") from e
+    if len(set(outputs)) != len(outputs):
+        raise ValueError(f"Output template {template!r} gives duplicate names")
+    workers = workers or os.cpu_count() or 1
+    jobs = iter(zip(inputs, outputs))
+    ahead = next(jobs, None)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {}
+
+        def submit():
+            # Submit the file read ahead, and start reading the one after it
+            nonlocal ahead
+            path, output = ahead
+            future = pool.submit(
+                render_one, path, output, options, cache, density_cache
+            )
+            futures[future] = path, output
+            ahead = next(jobs, None)
+            if ahead is not None:
+                threading.Thread(
+                    target=_read_ahead, args=(ahead[0],), daemon=True
+                ).start()
+
+        while ahead is not None and len(futures) < workers:
+            submit()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, output = futures.pop(future)
+                if ahead is not None:
+                    submit()
+                yield path, output, future.exception()
@@ -0,0 +1,520 @@
+# SPDX-FileCopyrightText: 2022 Jeff Epler for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""Benchmarks of fluxvis
+
+Synthetic flux images are written in each supported format, so that no real
+disk images are needed, and each stage of rendering them is timed
+separately.  Run ``fluxvis bench`` to print the results as JSON.
+
+Run ``python -m fluxvis.bench`` to time only starting up.  It exits with an
+error if starting the command line interface imports any of
+``HEAVY_MODULES``, which only the stages that need them should import.
+
+The ``test_`` functions time the same stages with pytest-benchmark, e.g.
+``pytest --benchmark-only fluxvis/bench.py``, and check rendering cases
+which once failed.
+"""
+
+import atexit
+import functools
+import json
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from . import a2rchery, circularize, open_flux, process, render_flux, shade
+from .greaseweazle.image.hfe import HFE
+from .greaseweazle.image.kryoflux import OOB, Op, sck
+from .greaseweazle.image.scp import SCP, SCPTrack
+from .writer import write_image
+
+# Modules which take longer to import than a small render takes
+HEAVY_MODULES = ("matplotlib", "scipy", "skimage")
+
+# Run in a fresh interpreter, printing the time taken by ``code`` and the
+# modules it imported
+IMPORT_SCRIPT = """\
+import sys, time
+start = time.perf_counter()
+try:
+    {code}
+except SystemExit:
+    pass
+print(time.perf_counter() - start, file=sys.stderr)
+print(" ".join(sys.modules), file=sys.stderr)
+"""
+
+STARTUP_CASES = {
+    "import": "import fluxvis",
+    "cli": "import fluxvis.__main__",
+    "help": "import runpy; sys.argv = ['fluxvis', '--help']; "
+    "runpy.run_module('fluxvis', run_name='__main__')",
+}
+
+# The rendering options of the command line interface, by default
+DEFAULT_OPTIONS = {
+    "side": 0,
+    "tracks": 80,
+    "start": 0,
+    "stride": 1,
+    "linear": False,
+    "slices": 4000,
+    "stacks": 6,
+    "diameter": 216.0,
+    "resolution": 960,
+    "oversample": 2,
+    "prefetch": 4,
+    "jobs": 1,
+    "revs": "first",
+}
+
+# Sectors per track of the synthetic tracks, each preceded by a gap
+SECTORS = 9
+GAP = 0.15
+
+
+def synthetic_cells(rng, bitrate, rpm):
+    """Generate one revolution of an MFM-like track, as the number of
+    bitcells in each flux interval
+
+    Intervals are 2, 3 or 4 cells at random, except in the gaps before each
+    sector which hold only the shortest intervals."""
+    cell = 1 / (2000 * bitrate)
+    rev = 60 / rpm
+    cells = rng.integers(2, 5, round(rev / cell / 2))
+    position = np.cumsum(cells) * (cell / rev)
+    cells[(position * SECTORS) % 1 < GAP] = 2
+    return cells[np.cumsum(cells) * cell <= rev]
+
+
+def synthetic_flux(rng, cells, revs, bitrate, jitter):
+    """Repeat a revolution of bitcells ``revs`` times as flux, with normally
+    distributed ``jitter`` as a fraction of each interval
+
+    Returns the flux intervals and the time of each revolution, in
+    seconds."""
+    intervals = np.tile(cells / (2000 * bitrate), revs)
+    intervals *= 1 + jitter * rng.standard_normal(len(intervals))
+    index = np.add.reduceat(intervals, np.arange(0, len(intervals), len(cells)))
+    return intervals, index
+
+
+def _ticks(seconds, sample_freq):
+    """Convert successive intervals in seconds to whole sample ticks, without
+    accumulating rounding error"""
+    edges = np.round(np.cumsum(seconds) * sample_freq)
+    return np.diff(edges, prepend=0).astype(np.int64)
+
+
+def write_scp(path, tracks, side, bitrate):
+    """Write synthetic tracks as an SCP file"""
+    image = SCP()
+    for cyl, cells, intervals, index in tracks:
+        ticks = _ticks(intervals, SCP.sample_freq)
+        # Intervals of 65536 ticks or more are preceded by a 0 for each 65536
+        runs, last = np.divmod(ticks, 0x10000)
+        words = np.zeros(np.sum(runs + 1), dtype=">u2")
+        ends = np.cumsum(runs + 1)
+        words[ends - 1] = np.maximum(last, 1)
+        rev_words = np.diff(ends[len(cells) - 1 :: len(cells)], prepend=0)
+        offsets = np.cumsum(rev_words) - rev_words
+        tdh = b"".join(
+            struct.pack("<III", rev_ticks, nr_words, 4 + len(index) * 12 + 2 * offset)
+            for rev_ticks, nr_words, offset in zip(
+                _ticks(index, SCP.sample_freq).tolist(),
+                rev_words.tolist(),
+                offsets.tolist(),
+            )
+        )
+        image.to_track[cyl * 2 + side] = SCPTrack(tdh, words.tobytes())
+        image.nr_revs = len(index)
+    with open(path, "wb") as f:
+        f.write(image.get_image())
+
+
+def kryoflux_stream(ticks, index_ticks):
+    """Encode flux and revolution times, in sample ticks, as a KryoFlux stream
+    with an index block at the start and after each revolution"""
+    overflows, value = np.divmod(ticks, 0x10000)
+    size = np.where(
+        value >= 0x800, 3, np.where((value > Op.OOB) & (value < 0x100), 1, 2)
+    )
+    ends = np.cumsum(overflows + size)
+    starts = ends - size
+    # Bytes before each flux which are not part of it are Ovl16 codes
+    stream = np.full(ends[-1], Op.Ovl16, dtype=np.uint8)
+    flux1, flux2, flux3 = size == 1, size == 2, size == 3
+    stream[starts[flux1]] = value[flux1]
+    stream[starts[flux2]] = value[flux2] >> 8
+    stream[starts[flux2] + 1] = value[flux2] & 0xFF
+    stream[starts[flux3]] = Op.Flux3
+    stream[starts[flux3] + 1] = value[flux3] >> 8
+    stream[starts[flux3] + 2] = value[flux3] & 0xFF
+
+    after = np.searchsorted(np.cumsum(ticks), np.cumsum(index_ticks))
+    blocks = []
+    previous = 0
+    for position in [0, *ends[after].tolist()]:
+        blocks.append(stream[previous:position].tobytes())
+        blocks.append(struct.pack("<2BH3I", Op.OOB, OOB.Index, 12, position, 0, 0))
+        previous = position
+    blocks.append(stream[previous:].tobytes())
+    blocks.append(struct.pack("<2BH2I", Op.OOB, OOB.StreamEnd, 8, len(stream), 0))
+    blocks.append(struct.pack("<2BH", Op.OOB, OOB.EOF, 0x0D0D))
+    return b"".join(blocks)
+
+
+def write_kryoflux(path, tracks, side, bitrate):
+    """Write synthetic tracks as a directory of KryoFlux stream files"""
+    os.makedirs(path, exist_ok=True)
+    for cyl, _, intervals, index in tracks:
+        # A flux after the last index lets readers see it
+        ticks = np.append(_ticks(intervals, sck), round(sck * 12e-6))
+        with open(os.path.join(path, f"{cyl:02d}.{side}.raw"), "wb") as f:
+            f.write(kryoflux_stream(ticks, _ticks(index, sck)))
+
+
+def write_hfe(path, tracks, side, bitrate):
+    """Write synthetic tracks as an HFE file, which holds the bitcells of one
+    revolution without jitter"""
+    image = HFE()
+    image.opts.bitrate = bitrate
+    for cyl, cells, _, _ in tracks:
+        bits = np.zeros(np.sum(cells), dtype=bool)
+        bits[np.cumsum(cells) - 1] = True
+        image.to_track[cyl, side] = (
+            len(bits),
+            np.packbits(bits, bitorder="little").tobytes(),
+        )
+    with open(path, "wb") as f:
+        f.write(image.get_image())
+
+
+def write_a2r(path, tracks, side, bitrate):
+    """Write synthetic tracks as a 3.5" A2R file, with all revolutions in one
+    capture"""
+    writer = a2rchery.A2RWriter("fluxvis")
+    writer.info.update(
+        version=1, creator="fluxvis", disk_type=2, write_protected=0, synchronized=0
+    )
+    for cyl, _, intervals, index in tracks:
+        ticks = np.maximum(_ticks(intervals, 8_000_000), 1)
+        # Intervals of 255 ticks or more continue in the next byte
+        runs, last = np.divmod(ticks, 255)
+        data = np.full(np.sum(runs + 1), 255, dtype=np.uint8)
+        data[np.cumsum(runs + 1) - 1] = last
+        writer.flux[cyl * 2 + side] = [
+            {
+                "capture_type": (
+                    a2rchery.kCaptureXTiming
+                    if len(index) > 1
+                    else a2rchery.kCaptureTiming
+                ),
+                "tick_count": int(_ticks(index, 8_000_000)[0]),
+                "data": data.tobytes(),
+            }
+        ]
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+GENERATORS = {
+    "scp": (".scp", write_scp),
+    "kryoflux": ("", write_kryoflux),
+    "hfe": (".hfe", write_hfe),
+    "a2r": (".a2r", write_a2r),
+}
+
+
+def synthetic_image(
+    directory,
+    fmt,
+    cyls,
+    side=0,
+    revs=2,
+    bitrate=250,
+    rpm=300,
+    jitter=0.02,
+    seed=0,
+):
+    """Write a synthetic flux image of the given cylinders in ``directory``,
+    returning its path
+
+    ``fmt`` is one of ``GENERATORS``, and ``bitrate`` is in kbit/s as for
+    HFE files, so that 250 is a double density disk."""
+    suffix, write = GENERATORS[fmt]
+    tracks = []
+    for cyl in cyls:
+        rng = np.random.default_rng((seed, cyl))
+        cells = synthetic_cells(rng, bitrate, rpm)
+        tracks.append((cyl, cells, *synthetic_flux(rng, cells, revs, bitrate, jitter)))
+    path = os.path.join(directory, f"synthetic-{fmt}{suffix}")
+    write(path, tracks, side, bitrate)
+    return path
+
+
+def _file_size(path):
+    if os.path.isdir(path):
+        return sum(_file_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def _cyls(options):
+    return [
+        cyl * options["stride"] + options["start"] for cyl in range(options["tracks"])
+    ]
+
+
+def get_tracks(flux, options):
+    """Read the tracks to be rendered"""
+    return [flux.get_track(cyl, options["side"]) for cyl in _cyls(options)]
+
+
+def cue_tracks(tracks):
+    """Cue tracks at their index"""
+    for track in tracks:
+        if track is not None:
+            track.cue_at_index()
+
+
+def render_density(flux, options):
+    """Render the linear density image, as ``process`` would"""
+    if options["linear"]:
+        major = round(options["tracks"] * options["stacks"])
+    else:
+        major = round(options["diameter"] * options["stacks"] / 2)
+    return render_flux(
+        flux,
+        options["side"],
+        options["tracks"],
+        options["start"],
+        options["stride"],
+        major,
+        options["slices"],
+        options["stacks"],
+        None,
+        options["prefetch"],
+        options["jobs"],
+        options["revs"],
+    )
+
+
+def time_stages(path, options, directory, repeat=3):
+    """Time each stage of rendering a flux image, taking the best of
+    ``repeat`` runs of each
+
+    ``render_flux`` reads and cues the tracks again, so its time includes
+    theirs.  The image is encoded as a PNG file in ``directory``."""
+    seconds = {}
+
+    def stage(name, begin):
+        seconds[name] = min(seconds.get(name, np.inf), time.perf_counter() - begin)
+
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        flux = open_flux(path)
+        stage("open", begin)
+        begin = time.perf_counter()
+        tracks = get_tracks(flux, options)
+        stage("get_track", begin)
+        begin = time.perf_counter()
+        cue_tracks(tracks)
+        stage("cue_at_index", begin)
+        begin = time.perf_counter()
+        density = render_density(flux, options)
+        stage("render_flux", begin)
+        if not options["linear"]:
+            begin = time.perf_counter()
+            density = circularize(density, options["resolution"], options["oversample"])
+            stage("circularize", begin)
+        begin = time.perf_counter()
+        image = shade(density)
+        stage("normalize", begin)
+        begin = time.perf_counter()
+        write_image(os.path.join(directory, "bench.png"), image)
+        stage("encode", begin)
+
+    return {
+        "file_bytes": _file_size(path),
+        "flux": sum(len(track.list) for track in tracks if track is not None),
+        "seconds": seconds,
+    }
+
+
+def startup_time(code, repeat=5):
+    """Time running ``code`` in a fresh interpreter, taking the best of
+    ``repeat`` runs, and list the heavy modules it imports"""
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT.format(code=code)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+            text=True,
+        )
+        seconds, modules = result.stderr.splitlines()[-2:]
+        best = min(float(seconds), best or float("inf"))
+    heavy = sorted(
+        {name.split(".")[0] for name in modules.split()}.intersection(HEAVY_MODULES)
+    )
+    return {"seconds": best, "heavy_modules": heavy}
+
+
+def bench_startup(repeat=5):
+    """Time importing fluxvis and starting its command line interface"""
+    return {name: startup_time(code, repeat) for name, code in STARTUP_CASES.items()}
+
+
+def run_benchmarks(
+    options,
+    formats=tuple(GENERATORS),
+    revs=2,
+    bitrate=250,
+    rpm=300,
+    jitter=0.02,
+    repeat=3,
+    startup=True,
+):
+    """Generate synthetic images in each of ``formats`` and time rendering
+    them with the ``process`` options, returning the results as a dict
+
+    Options left as None, such as ``tracks`` when it is to be found from the
+    image, take their values from ``DEFAULT_OPTIONS``."""
+    options = {
+        name: DEFAULT_OPTIONS.get(name) if value is None else value
+        for name, value in options.items()
+    }
+    results = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "options": {name: options[name] for name in DEFAULT_OPTIONS},
+        "synthetic": {"revs": revs, "bitrate": bitrate, "rpm": rpm, "jitter": jitter},
+        "formats": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for fmt in formats:
+            begin = time.perf_counter()
+            path = synthetic_image(
+                directory,
+                fmt,
+                _cyls(options),
+                options["side"],
+                revs,
+                bitrate,
+                rpm,
+                jitter,
+            )
+            generate = time.perf_counter() - begin
+            result = time_stages(path, options, directory, repeat)
+            results["formats"][fmt] = {"generate_seconds": generate, **result}
+    if startup:
+        results["startup"] = bench_startup(repeat)
+    return results
+
+
+@functools.lru_cache(maxsize=None)
+def _sample(fmt):
+    """A synthetic image for the pytest-benchmark tests, and its options"""
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, True)
+    options = dict(DEFAULT_OPTIONS)
+    path = synthetic_image(directory, fmt, _cyls(options))
+    return path, options
+
+
+def _bench_get_track(benchmark, fmt):
+    path, options = _sample(fmt)
+    benchmark(get_tracks, open_flux(path), options)
+
+
+def test_get_track_scp(benchmark):
+    """Time reading the tracks of an SCP file"""
+    _bench_get_track(benchmark, "scp")
+
+
+def test_get_track_kryoflux(benchmark):
+    """Time reading the tracks of KryoFlux stream files"""
+    _bench_get_track(benchmark, "kryoflux")
+
+
+def test_get_track_hfe(benchmark):
+    """Time reading the tracks of an HFE file"""
+    _bench_get_track(benchmark, "hfe")
+
+
+def test_get_track_a2r(benchmark):
+    """Time reading the tracks of an A2R file"""
+    _bench_get_track(benchmark, "a2r")
+
+
+def test_cue_at_index(benchmark):
+    """Time cueing the tracks of an SCP file at their index"""
+    path, options = _sample("scp")
+    flux = open_flux(path)
+    benchmark.pedantic(
+        cue_tracks, setup=lambda: ((get_tracks(flux, options),), {}), rounds=5
+    )
+
+
+def test_render_flux(benchmark):
+    """Time rendering the linear density image of an SCP file"""
+    path, options = _sample("scp")
+    benchmark(render_density, open_flux(path), options)
+
+
+def test_circularize(benchmark):
+    """Time warping a linear density image to polar"""
+    path, options = _sample("scp")
+    density = render_density(open_flux(path), options)
+    benchmark(circularize, density, options["resolution"], options["oversample"])
+
+
+def test_normalize(benchmark):
+    """Time scaling a polar density image to 8 bits"""
+    path, options = _sample("scp")
+    density = render_density(open_flux(path), options)
+    benchmark(shade, circularize(density, options["resolution"], options["oversample"]))
+
+
+def test_encode(benchmark, tmp_path):
+    """Time writing an image as a PNG file"""
+    path, options = _sample("scp")
+    density = render_density(open_flux(path), options)
+    image = shade(circularize(density, options["resolution"], options["oversample"]))
+    benchmark(write_image, str(tmp_path / "bench.png"), image)
+
+
+def test_variance_one_revolution(tmp_path):
+    """Check that the variance of single revolutions renders as a black image
+    rather than dividing by a zero maximum"""
+    options = dict(DEFAULT_OPTIONS, tracks=4, revs="variance", resolution=64)
+    path = synthetic_image(str(tmp_path), "scp", _cyls(options), revs=1)
+    with np.errstate(all="raise"):
+        image = process(open_flux(path), location=None, **options)
+    assert image.shape == (64, 64)
+    assert not image.any()
+
+
+def main():
+    """Print the startup benchmark results as JSON, failing if starting up
+    imports heavy modules"""
+    results = {"startup": bench_startup()}
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    if any(case["heavy_modules"] for case in results["startup"].values()):
+        sys.exit("Heavy modules were imported at startup")
+
+
+if __name__ == "__main__":
+    main()
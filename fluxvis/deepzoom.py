@@ -0,0 +1,175 @@
+# SPDX-FileCopyrightText: 2022 Jeff Epler for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""Render polar flux images as a DeepZoom tile pyramid
+
+Every level of the pyramid is warped from its own linear density image, with
+the slices and stacks scaled to the level's resolution, rather than by
+downsampling the full resolution image.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import linear_density, scratch_array
+from .invpolar import inverse_polar_tile
+from .writer import PNGWriter
+
+DZI_TEMPLATE = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008"
+  Format="png" Overlap="0" TileSize="{tile_size}">
+  <Size Width="{size}" Height="{size}"/>
+</Image>
+"""
+
+
+def level_sizes(size):
+    """The image size of each DeepZoom level, from 1 pixel up to ``size``"""
+    sizes = [size]
+    while sizes[-1] > 1:
+        sizes.append((sizes[-1] + 1) // 2)
+    return sizes[::-1]
+
+
+def rebin(counts, slices):
+    """Reduce per-cylinder slice histograms to ``slices`` slices, giving the
+    mean count of the original slices in each"""
+    if slices == counts.shape[1]:
+        return counts
+    edges = np.arange(slices) * counts.shape[1] // slices
+    widths = np.diff(edges, append=counts.shape[1])
+    return (np.add.reduceat(counts, edges, axis=1) / widths).astype(np.float32)
+
+
+def write_pixels(path, pixels, scale):
+    """Scale warped pixels to 8 bits and write them as a PNG tile"""
+    with PNGWriter(path, pixels.shape[1], pixels.shape[0]) as writer:
+        writer.write(np.minimum(pixels * scale, 255).astype(np.uint8))
+
+
+def write_tile(path, density, size, rows, cols, scale, oversample):
+    """Warp and write one tile of a level ``size`` pixels square"""
+    pixels = inverse_polar_tile(
+        density, rows, cols, output_shape=(size, size), oversample=oversample
+    )
+    write_pixels(path, pixels, scale)
+
+
+def warp_tile(out, density, rows, cols, oversample):
+    """Warp one tile of a level into ``out``, the whole level's pixels"""
+    out[rows.start : rows.stop, cols.start : cols.stop] = inverse_polar_tile(
+        density, rows, cols, output_shape=out.shape, oversample=oversample
+    )
+
+
+def tile_ranges(size, tile_size):
+    """The column, row, and the ranges of rows and columns of each tile of a
+    level ``size`` pixels square"""
+    for row in range(0, size, tile_size):
+        for col in range(0, size, tile_size):
+            yield (
+                col // tile_size,
+                row // tile_size,
+                range(row, min(row + tile_size, size)),
+                range(col, min(col + tile_size, size)),
+            )
+
+
+def write_deepzoom(
+    counts,
+    track_duration,
+    output,
+    *,
+    diameter,
+    slices,
+    stacks,
+    resolution,
+    oversample,
+    tile_size=256,
+    jobs=None,
+    subtracks=1,
+    scratch=None,
+):
+    """Write per-cylinder slice histograms as a DeepZoom pyramid of polar
+    images, ``output`` (a .dzi file) and the tiles in ``output``_files
+
+    The top level is ``resolution`` pixels square with the given ``slices``
+    and ``stacks``; lower levels scale both down with the image, keeping at
+    least 2 rows per cylinder, or one more than its ``subtracks``.  Each
+    level's brightness is corrected for the share of its rows left blank
+    between cylinders, so that the image does not change brightness as it is
+    zoomed.
+
+    The top level is scaled as ``shade`` would scale it, by its densest
+    pixel, so it matches the image written by ``fluxvis write``.  To find
+    that pixel, the top level is warped first into a temporary file in the
+    ``scratch`` directory.  Tiles are warped and written on ``jobs`` threads,
+    one per CPU by default, a level at a time."""
+    files = os.path.splitext(output)[0] + "_files"
+    sizes = level_sizes(resolution)
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        top = scratch_array((resolution, resolution), np.float32, scratch)
+        density = linear_density(
+            counts,
+            track_duration,
+            round(diameter * stacks / 2),
+            stacks,
+            subtracks=subtracks,
+        )
+        futures = [
+            pool.submit(warp_tile, top, density, rows, cols, oversample)
+            for _, _, rows, cols in tile_ranges(resolution, tile_size)
+        ]
+        for future in futures:
+            future.result()
+        scale = 255 / (np.max(top) or 1)
+
+        for level, size in enumerate(sizes):
+            directory = os.path.join(files, str(level))
+            os.makedirs(directory, exist_ok=True)
+            if size == resolution:
+                futures = [
+                    pool.submit(
+                        write_pixels,
+                        os.path.join(directory, f"{col}_{row}.png"),
+                        top[rows.start : rows.stop, cols.start : cols.stop],
+                        scale,
+                    )
+                    for col, row, rows, cols in tile_ranges(size, tile_size)
+                ]
+            else:
+                fraction = size / resolution
+                level_stacks = max(1 + subtracks, round(stacks * fraction))
+                level_slices = max(2, round(slices * fraction))
+                level_scale = scale * (stacks - 1) / stacks
+                level_scale *= level_stacks / (level_stacks - 1)
+                density = linear_density(
+                    rebin(counts, level_slices),
+                    track_duration,
+                    round(diameter * level_stacks / 2),
+                    level_stacks,
+                    subtracks=subtracks,
+                )
+                futures = [
+                    pool.submit(
+                        write_tile,
+                        os.path.join(directory, f"{col}_{row}.png"),
+                        density,
+                        size,
+                        rows,
+                        cols,
+                        level_scale,
+                        oversample,
+                    )
+                    for col, row, rows, cols in tile_ranges(size, tile_size)
+                ]
+            # Finish each level before the next, so only one density is kept
+            for future in futures:
+                future.result()
+
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(DZI_TEMPLATE.format(tile_size=tile_size, size=resolution))
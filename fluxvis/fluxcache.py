@@ -0,0 +1,310 @@
+# SPDX-FileCopyrightText: 2022 Jeff Epler for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""Keep decoded flux on disk so that re-rendering a capture skips decoding
+
+Each decoded track is stored as two ``.npy`` files: the flux times, which are
+mapped straight back into memory, and the index times along with the few
+other values needed to rebuild the track.  Files are named by a hash of the
+source's path, size and modification time plus ``CACHE_VERSION``, the
+cylinder and side, so a changed capture is never served stale flux.  The
+least recently used entries are removed when the cache grows beyond its size
+limit.
+
+Linear density and status images may be kept too, named by a hash of the
+source and every parameter that they depend on, so that changing only how
+they are projected or shaded need not render them again.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from .greaseweazle.flux import Flux
+
+# Part of every entry's name, so that flux decoded or images rendered by an
+# older version are not served; increase it when either changes
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    """The directory used for the cache unless another is given"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "fluxvis")
+
+
+def source_key(path):
+    """Hash the identity of a flux file, or of every stream file in a
+    KryoFlux set, whether it is opened by its directory or by one of its
+    stream files"""
+    path = os.path.realpath(path)
+    if os.path.isdir(path):
+        names = sorted(os.listdir(path))
+        paths = [os.path.join(path, name) for name in names]
+    elif path.lower().endswith(".raw"):
+        # The set is every stream file named like this one, as KryoFlux reads
+        directory, name = os.path.split(path)
+        prefix = re.sub(r"(\d{2}.[01])?.raw$", "", name)
+        pattern = re.compile(re.escape(prefix) + r"\d{2,}\.[01]\.raw")
+        names = sorted(
+            name for name in os.listdir(directory) if pattern.fullmatch(name)
+        )
+        paths = [os.path.join(directory, name) for name in names] or [path]
+    else:
+        paths = [path]
+    digest = hashlib.blake2b(digest_size=16)
+    for name in paths:
+        st = os.stat(name)
+        digest.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """A directory of entries, each a group of named ``.npy`` files, limited
+    to ``max_bytes`` in total
+
+    The last file of an entry to be written marks it as present, and its
+    modification time records when the entry was last used."""
+
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self._size = None
+
+    def _path(self, name, part):
+        return os.path.join(self.directory, f"{name}.{part}.npy")
+
+    def exists(self, name, marker):
+        """Whether an entry, marked by its last part, is in the cache"""
+        return os.path.exists(self._path(name, marker))
+
+    def read(self, name, parts, mapped=()):
+        """Read the parts of an entry, mapping those in ``mapped`` into
+        memory, or return None if it is not there"""
+        try:
+            arrays = {
+                part: np.load(
+                    self._path(name, part), mmap_mode="r" if part in mapped else None
+                )
+                for part in parts
+            }
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(self._path(name, parts[-1]))
+        except OSError:
+            pass
+        return arrays
+
+    def fits(self, nbytes):
+        """Whether an entry of ``nbytes`` would survive trimming the cache"""
+        return nbytes <= self.max_bytes * 9 // 10
+
+    def write(self, name, arrays):
+        """Add an entry from a dict of its parts, then trim the cache if it is
+        too big
+
+        An entry too big to survive trimming is not written, and False is
+        returned."""
+        if not self.fits(sum(np.asarray(data).nbytes for data in arrays.values())):
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        size = 0
+        # Each file is renamed into place so readers never see part of one
+        for part, data in arrays.items():
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, data)
+                size += os.path.getsize(temp)
+                os.replace(temp, self._path(name, part))
+            except BaseException:
+                os.unlink(temp)
+                raise
+        if self._size is not None:
+            self._size += size
+        if self.size() > self.max_bytes:
+            self.trim()
+        return True
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".npy"):
+                    continue
+                # Another process may remove an entry while it is listed
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """The total size of the cache in bytes"""
+        if self._size is None:
+            try:
+                self._size = sum(size for _, size, _ in self._entries())
+            except FileNotFoundError:
+                self._size = 0
+        return self._size
+
+    def trim(self):
+        """Remove the least recently used entries until the cache is under
+        90% of its size limit"""
+        groups = {}
+        for mtime, size, path in self._entries():
+            name = os.path.basename(path).split(".", 1)[0]
+            used, group_size, paths = groups.get(name, (0, 0, []))
+            groups[name] = max(used, mtime), group_size + size, paths + [path]
+        size = sum(group_size for _, group_size, _ in groups.values())
+        for _, group_size, paths in sorted(groups.values()):
+            if size <= self.max_bytes * 9 // 10:
+                break
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            size -= group_size
+        self._size = size
+
+
+class FluxCache(DiskCache):
+    """A directory of decoded tracks"""
+
+    def contains(self, key, cyl, side):
+        """Whether a track is in the cache"""
+        return self.exists(f"{key}-{CACHE_VERSION}-{cyl}-{side}", "index")
+
+    def load(self, key, cyl, side):
+        """Load a track from the cache, or return None if it is not there"""
+        arrays = self.read(
+            f"{key}-{CACHE_VERSION}-{cyl}-{side}", ("flux", "index"), ("flux",)
+        )
+        if arrays is None:
+            return None
+        meta = arrays["index"]
+        sample_freq, splice, index_cued = meta[:3]
+        flux = Flux(meta[3:], arrays["flux"], sample_freq.item(), bool(index_cued))
+        flux.splice = int(splice)
+        return flux
+
+    def store(self, key, cyl, side, flux):
+        """Add a track to the cache"""
+        meta = np.concatenate(
+            (
+                [flux.sample_freq, getattr(flux, "splice", 0), flux.index_cued],
+                flux.index_list,
+            )
+        ).astype(np.float64)
+        self.write(
+            f"{key}-{CACHE_VERSION}-{cyl}-{side}", {"flux": flux.list, "index": meta}
+        )
+
+
+class CachedFlux:
+    """Serve tracks of a flux image from a ``FluxCache`` where possible,
+    adding the others as they are decoded"""
+
+    def __init__(self, flux, key, cache):
+        self._flux = flux
+        self._key = key
+        self._cache = cache
+
+    @property
+    def sample_freq(self):
+        """The sample frequency of the underlying image"""
+        return self._flux.sample_freq
+
+    def prefetch(self, tracks, workers=4):
+        """Read ahead only the tracks which are not cached"""
+        start_prefetch = getattr(self._flux, "prefetch", None)
+        if start_prefetch is None:
+            return
+        tracks = [
+            (cyl, side)
+            for cyl, side in tracks
+            if not self._cache.contains(self._key, cyl, side)
+        ]
+        if tracks:
+            start_prefetch(tracks, workers)
+
+    def close(self):
+        """Stop reading ahead, if the underlying image does"""
+        close = getattr(self._flux, "close", None)
+        if close is not None:
+            close()
+
+    def track_map(self):
+        """The tracks present in the underlying image"""
+        return self._flux.track_map()
+
+    def has_track(self, cyl, side):
+        """Whether a track is present in the underlying image"""
+        return self._flux.has_track(cyl, side)
+
+    def get_track(self, cyl, side):
+        """Retrieve a track from the cache, or decode and cache it"""
+        track = self._cache.load(self._key, cyl, side)
+        if track is None:
+            track = self._flux.get_track(cyl, side)
+            if track is not None:
+                self._cache.store(self._key, cyl, side, track)
+        return track
+
+
+class DensityCache:
+    """Keep linear density images, and status images if there are any, by the
+    parameters they were rendered with
+
+    The most recent ``entries`` are kept in memory, and if ``disk`` is a
+    ``DiskCache`` all of them are also kept there, with the density mapped
+    back into memory when it is loaded."""
+
+    def __init__(self, disk=None, entries=4):
+        self.disk = disk
+        self.entries = entries
+        self._memory = OrderedDict()
+
+    @staticmethod
+    def key(*params):
+        """Hash the parameters of a linear render, and the cache version"""
+        params = CACHE_VERSION, params
+        return hashlib.blake2b(repr(params).encode(), digest_size=16).hexdigest()
+
+    def load(self, key, has_status):
+        """Load the density and status images, or return None if they are not
+        in the cache"""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.disk is None:
+            return None
+        parts = ("density", "status") if has_status else ("density",)
+        arrays = self.disk.read(key, parts, ("density",))
+        if arrays is None:
+            return None
+        return arrays["density"], arrays.get("status")
+
+    def store(self, key, density, status):
+        """Add density and status images to the cache
+
+        Images kept in a scratch file (a ``np.memmap``), which are rendered
+        out of core because they are large, are not copied to the disk cache,
+        and nor are images too big for it."""
+        if self.entries:
+            self._memory[key] = density, status
+            while len(self._memory) > self.entries:
+                self._memory.popitem(last=False)
+        if self.disk is not None and not isinstance(density, np.memmap):
+            arrays = {"density": density}
+            if status is not None:
+                arrays["status"] = status
+            self.disk.write(key, arrays)
@@ -5,14 +5,29 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
+import numpy as np
+
 from . import error
 
 
+def flux_array(flux_list):
+    """Returns @flux_list as a contiguous NumPy array of a compact type:
+    uint32 for whole-tick flux times (where they fit), otherwise float32.
+    """
+    a = np.asarray(flux_list)
+    if a.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+    if ((a.dtype.kind in 'iu' or np.array_equal(a, np.round(a)))
+        and a.min() >= 0 and a.max() < 2**32):
+        return np.ascontiguousarray(a, dtype=np.uint32)
+    return np.ascontiguousarray(a, dtype=np.float32)
+
+
 class Flux:
 
     def __init__(self, index_list, flux_list, sample_freq, index_cued=True):
-        self.index_list = index_list
-        self.list = flux_list
+        self.index_list = np.asarray(index_list)
+        self.list = flux_array(flux_list)
         self.sample_freq = sample_freq
         self.splice = 0
         self.index_cued = index_cued
@@ -21,7 +36,7 @@ class Flux:
     def __str__(self):
         s = "\nFlux: %.2f MHz" % (self.sample_freq*1e-6)
         s += ("\n Total: %u samples, %.2fms\n"
-              % (len(self.list), sum(self.list)*1000/self.sample_freq))
+              % (len(self.list), self.total()*1000/self.sample_freq))
         rev = 0
         for t in self.index_list:
             s += " Revolution %u: %.2fms\n" % (rev, t*1000/self.sample_freq)
@@ -31,7 +46,12 @@ class Flux:
 
     def summary_string(self):
         return ("Raw Flux (%u flux in %.2fms)"
-                % (len(self.list), sum(self.list)*1000/self.sample_freq))
+                % (len(self.list), self.total()*1000/self.sample_freq))
+
+
+    def total(self):
+        """Total of all flux times, in sample ticks."""
+        return self.list.sum(dtype=np.float64)
 
 
     def append(self, flux):
@@ -41,13 +61,14 @@ class Flux:
             f_list, i_list = flux.list, flux.index_list
         else:
             factor = self.sample_freq / flux.sample_freq
-            f_list = [x*factor for x in flux.list]
-            i_list = [x*factor for x in flux.index_list]
+            f_list = flux.list * factor
+            i_list = flux.index_list * factor
         # Any trailing flux is incorporated into the first revolution of
         # the appended flux.
-        rev0 = i_list[0] + sum(self.list) - sum(self.index_list)
-        self.index_list += [rev0] + i_list[1:]
-        self.list += f_list
+        rev0 = i_list[0] + self.total() - self.index_list.sum()
+        self.index_list = np.concatenate(
+            (self.index_list, [rev0], i_list[1:]))
+        self.list = flux_array(np.concatenate((self.list, f_list)))
 
 
     def cue_at_index(self):
@@ -55,16 +76,16 @@ class Flux:
         if self.index_cued:
             return
 
-        # Clip the initial partial revolution.
+        # Clip the initial partial revolution: find the first flux which
+        # crosses the index and keep only its remainder beyond the index.
         to_index = self.index_list[0]
-        for i in range(len(self.list)):
-            to_index -= self.list[i]
-            if to_index < 0:
-                break
-        if to_index < 0:
-            self.list = [-to_index] + self.list[i+1:]
+        total = np.cumsum(self.list, dtype=np.float64)
+        i = np.searchsorted(total, to_index, 'right')
+        if i < len(self.list):
+            self.list = flux_array(np.concatenate(
+                ([total[i] - to_index], self.list[i+1:])))
         else: # we ran out of flux
-            self.list = []
+            self.list = self.list[:0]
         self.index_list = self.index_list[1:]
         self.index_cued = True
 
@@ -77,15 +98,12 @@ class Flux:
                     "Cannot write single-revolution unaligned raw flux")
         splice_at_index = (self.splice == 0)
 
-        # Copy the required amount of flux to a fresh list.
-        flux_list = []
+        # Copy the required amount of flux to a fresh array.
         to_index = self.index_list[0]
-        remain = to_index + self.splice
-        for f in self.list:
-            if f > remain:
-                break
-            flux_list.append(f)
-            remain -= f
+        total = np.cumsum(self.list, dtype=np.float64)
+        i = np.searchsorted(total, to_index + self.splice, 'right')
+        flux_list = self.list[:i]
+        remain = to_index + self.splice - (total[i-1] if i else 0)
 
         if not cue_at_index:
             # We will write more than one revolutionm and terminate the
@@ -93,23 +111,24 @@ class Flux:
             # with "safe" 4us sample values, in case the drive motor is a
             # little fast.
             if remain > 0:
-                flux_list.append(remain)
+                flux_list = np.append(flux_list, remain)
             prepend = max(round(to_index/10 - self.splice), 0)
             if prepend != 0:
                 four_us = max(self.sample_freq * 4e-6, 1)
-                flux_list = [four_us]*round(prepend/four_us) + flux_list
+                flux_list = np.concatenate(
+                    (np.full(round(prepend/four_us), four_us), flux_list))
             splice_at_index = False
         elif splice_at_index:
             # Extend with "safe" 4us sample values, to avoid unformatted area
             # at end of track if drive motor is a little slow.
             four_us = max(self.sample_freq * 4e-6, 1)
             if remain > four_us:
-                flux_list.append(remain)
-            for i in range(round(to_index/(10*four_us))):
-                flux_list.append(four_us)
+                flux_list = np.append(flux_list, remain)
+            flux_list = np.concatenate(
+                (flux_list, np.full(round(to_index/(10*four_us)), four_us)))
         elif remain > 0:
             # End the write exactly where specified.
-            flux_list.append(remain)
+            flux_list = np.append(flux_list, remain)
 
         return WriteoutFlux(to_index, flux_list, self.sample_freq,
                             index_cued = cue_at_index,
@@ -160,14 +179,14 @@ class WriteoutFlux(Flux):
              % (self.sample_freq*1e-6,
                 self.index_list[0]*1000/self.sample_freq,
                 ("Write all", "Terminate at index")[self.terminate_at_index],
-                len(self.list), sum(self.list)*1000/self.sample_freq))
+                len(self.list), self.total()*1000/self.sample_freq))
         return s
 
 
     def summary_string(self):
         s = ("Flux: %.1fms period, %.1f ms total, %s"
              % (self.index_list[0]*1000/self.sample_freq,
-                sum(self.list)*1000/self.sample_freq,
+                self.total()*1000/self.sample_freq,
                 ("Write all", "Terminate at index")[self.terminate_at_index]))
         return s
 
@@ -75,6 +75,14 @@ class HFE(Image):
         return hfe
 
 
+    def track_map(self):
+        return sorted(self.to_track)
+
+
+    def has_track(self, cyl, side):
+        return (cyl,side) in self.to_track
+
+
     def get_track(self, cyl, side):
         if (cyl,side) not in self.to_track:
             return None
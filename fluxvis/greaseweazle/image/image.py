@@ -43,13 +43,25 @@ class Image:
         obj.noclobber = noclobber
         return obj
 
+    # Non-empty tracks, as a sorted list of (cyl, head) pairs. Subclasses
+    # which can list their tracks without decoding them override this;
+    # otherwise every track is probed, so prefer has_track() where possible.
+    def track_map(self):
+        return [(c,h) for c in range(101) for h in range(2)
+                if self.has_track(c,h)]
+
+    # Whether a track is non-empty. Subclasses which can tell without
+    # decoding it override this.
+    def has_track(self, cyl, side):
+        return self.get_track(cyl, side) is not None
+
     # Maximum non-empty cylinder on each head, or -1 if no cylinders exist.
     # Returns a list of integers, indexed by head.
     def max_cylinder(self):
         r = list()
         for h in range(2):
             for c in range(100, -2, -1):
-                if c < 0 or self.get_track(c,h) is not None:
+                if c < 0 or self.has_track(c,h):
                     r.append(c)
                     break
         return r
@@ -7,6 +7,10 @@
 
 import struct, re, math, os
 import itertools as it
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from .. import error
 from ..flux import Flux
@@ -30,6 +34,88 @@ class OOB:
     KFInfo     =  4
     EOF        = 13
 
+# Length of each opcode within the data stream, indexed by opcode byte.
+op_len = np.ones(256, dtype=np.int64)
+op_len[:8] = 2                  # Flux2
+op_len[Op.Nop2] = 2
+op_len[Op.Nop3] = 3
+op_len[Op.Flux3] = 3
+op_len[Op.OOB] = 0              # OOB blocks are not part of the stream
+
+def decode_stream(dat):
+    """Decodes a KryoFlux stream file into arrays of index and flux times.
+    """
+
+    d = np.frombuffer(dat, dtype=np.uint8)
+    n = len(d)
+    if n == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    # Zero padding lets us read opcode arguments past the end of the file.
+    p = np.zeros(n+8, dtype=np.int64)
+    p[:n] = d
+
+    # Find the start of every opcode. Only multi-byte opcodes can move the
+    # parse off the next byte, so follow the chain of those reached from
+    # position 0 (by pointer doubling): every byte that is not covered by
+    # one of them is itself an opcode.
+    cand = np.flatnonzero(op_len[d] != 1)
+    nxt = cand + op_len[d[cand]]
+    oob = d[cand] == Op.OOB
+    c = cand[oob]
+    nxt[oob] = c + 4 + p[c+2] + (p[c+3] << 8)
+    nxt[oob & (p[cand+1] == OOB.EOF)] = n
+    jump = np.append(np.searchsorted(cand, nxt), len(cand))
+    real = np.zeros(len(cand)+1, dtype=bool)
+    real[np.searchsorted(cand, 0)] = True
+    while True:
+        tgt = jump[real]
+        if (tgt == len(cand)).all():
+            break
+        real[tgt] = True
+        jump = jump[jump]
+    real = real[:-1]
+    covered = np.zeros(n+1, dtype=np.int64)
+    np.add.at(covered, cand[real]+1, 1)
+    np.add.at(covered, np.minimum(nxt[real], n), -1)
+    ops = np.flatnonzero(np.cumsum(covered[:n]) == 0)
+    op = d[ops]
+
+    # Stream position at the start of each opcode.
+    stream_idx = np.cumsum(op_len[op]) - op_len[op]
+
+    # OOB blocks: check stream positions and collect index positions.
+    oob = ops[op == Op.OOB]
+    oob_op = p[oob+1]
+    oob_pos = p[oob+4] | (p[oob+5] << 8) | (p[oob+6] << 16) | (p[oob+7] << 24)
+    chk = (oob_op == OOB.StreamInfo) | (oob_op == OOB.StreamEnd)
+    error.check(np.array_equal(oob_pos[chk],
+                               stream_idx[op == Op.OOB][chk]),
+                "Out-of-sync during KryoFlux stream read")
+    index = oob_pos[oob_op == OOB.Index]
+
+    # Flux values, including any preceding Ovl16 carries.
+    is_flux = (op <= 7) | (op == Op.Flux3) | (op > Op.OOB)
+    val = np.where(op <= 7, (op.astype(np.int64) << 8) + p[ops+1], op)
+    val = np.where(op == Op.Flux3, (p[ops+1] << 8) + p[ops+2], val)
+    ovl = np.cumsum(op == Op.Ovl16)[is_flux]
+    flux_list = val[is_flux] + np.diff(ovl, prepend=0) * 0x10000
+
+    # Each index marker lands on the first opcode at or after its stream
+    # position, and at most one marker is processed per opcode.
+    nr_flux = np.cumsum(is_flux) - is_flux
+    total = np.concatenate(([0], np.cumsum(flux_list)))
+    at_index, prev = [], -1
+    for pos in index:
+        i = max(np.searchsorted(stream_idx, pos), prev+1)
+        if i >= len(ops):
+            break
+        at_index.append(total[nr_flux[i]])
+        prev = i
+    index_list = np.diff(at_index, prepend=0).astype(np.int64)
+
+    return index_list, flux_list
+
+
 class KryoFlux(Image):
 
     def __init__(self, name):
@@ -38,6 +124,17 @@ class KryoFlux(Image):
         else:
             m = re.search("(\d{2}.[01])?.raw$", name)
             self.basename = name[:m.start()]
+        self.pool = None
+        self.workers = None
+        self.pending = dict()
+        self.queue = deque()
+
+
+    def __getstate__(self):
+        # Prefetch state belongs to this process only.
+        state = self.__dict__.copy()
+        state.update(pool=None, workers=None, pending=dict(), queue=deque())
+        return state
 
 
     @classmethod
@@ -51,7 +148,79 @@ class KryoFlux(Image):
         return cls(name)
 
 
+    def prefetch(self, tracks, workers=4):
+        """Reads and decodes the (cyl, side) pairs in @tracks, in order, on
+        a pool of @workers threads. get_track() returns prefetched tracks
+        as they are requested. At most 2*@workers tracks are held ahead of
+        the caller. A further call replaces the tracks still queued, and
+        starts a new pool if @workers has changed.
+        """
+        if self.pool is not None and self.workers != workers:
+            self.close()
+        self.queue = deque(tracks)
+        self.depth = 2 * workers
+        self.workers = workers
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        self._prefetch_more()
+
+
+    def close(self):
+        """Stops prefetching: tracks not yet read are cancelled, and the
+        thread pool is shut down. get_track() still reads tracks directly.
+        """
+        self.queue = deque()
+        for track in self.pending.values():
+            track.cancel()
+        self.pending = dict()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+    def __del__(self):
+        if getattr(self, 'pool', None) is not None:
+            self.close()
+
+
+    def _prefetch_more(self):
+        while self.queue and len(self.pending) < self.depth:
+            cyl, side = self.queue.popleft()
+            self.pending[cyl,side] = self.pool.submit(
+                self._read_track, cyl, side)
+        if not self.queue and not self.pending:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+    def track_map(self):
+        """Lists the tracks from the names of the stream files, without
+        reading them.
+        """
+        directory, prefix = os.path.split(self.basename)
+        tracks = list()
+        for name in os.listdir(directory or '.'):
+            m = re.fullmatch(re.escape(prefix) + r'(\d{2,})\.([01])\.raw', name)
+            if m is not None:
+                tracks.append((int(m.group(1)), int(m.group(2))))
+        return sorted(tracks)
+
+
+    def has_track(self, cyl, side):
+        return os.path.isfile(self.basename + '%02d.%d.raw' % (cyl, side))
+
+
     def get_track(self, cyl, side):
+        if (cyl,side) in self.pending:
+            track = self.pending.pop((cyl,side))
+            self._prefetch_more()
+            return track.result()
+        if self.pool is not None and (cyl,side) in self.queue:
+            self.queue.remove((cyl,side))
+        return self._read_track(cyl, side)
+
+
+    def _read_track(self, cyl, side):
 
         name = self.basename + '%02d.%d.raw' % (cyl, side)
         try:
@@ -60,92 +229,14 @@ class KryoFlux(Image):
         except FileNotFoundError:
             return None
 
-        # Parse the index-pulse stream positions.
-        index = []
-        idx = 0
-        while idx < len(dat):
-            op = dat[idx]
-            if op == Op.OOB:
-                oob_op, oob_sz = struct.unpack('<BH', dat[idx+1:idx+4])
-                idx += 4
-                if oob_op == OOB.Index:
-                    pos, = struct.unpack('<I', dat[idx:idx+4])
-                    index.append(pos)
-                elif oob_op == OOB.EOF:
-                    break
-                idx += oob_sz
-            elif op == Op.Nop3 or op == Op.Flux3:
-                idx += 3
-            elif op <= 7 or op == Op.Nop2:
-                idx += 2
-            else:
-                idx += 1
-
-        # Build the flux and index lists for the Flux object.
-        flux, flux_list, index_list = [], [], []
-        val, index_idx, stream_idx, idx = 0, 0, 0, 0
-        while idx < len(dat):
-            if index_idx < len(index) and stream_idx >= index[index_idx]:
-                # We've passed an index marker.
-                index_list.append(sum(flux))
-                flux_list += flux
-                flux = []
-                index_idx += 1
-            op = dat[idx]
-            if op <= 7:
-                # Flux2
-                val += (op << 8) + dat[idx+1]
-                flux.append(val)
-                val = 0
-                stream_idx += 2
-                idx += 2
-            elif op <= 10:
-                # Nop1, Nop2, Nop3
-                nr = op-7
-                stream_idx += nr
-                idx += nr
-            elif op == Op.Ovl16:
-                # Ovl16
-                val += 0x10000
-                stream_idx += 1
-                idx += 1
-            elif op == Op.Flux3:
-                # Flux3
-                val += (dat[idx+1] << 8) + dat[idx+2]
-                flux.append(val)
-                val = 0
-                stream_idx += 3
-                idx += 3
-            elif op == Op.OOB:
-                # OOB
-                oob_op, oob_sz = struct.unpack('<BH', dat[idx+1:idx+4])
-                idx += 4
-                if oob_op == OOB.StreamInfo or oob_op == OOB.StreamEnd:
-                    pos, = struct.unpack('<I', dat[idx:idx+4])
-                    error.check(pos == stream_idx,
-                                "Out-of-sync during KryoFlux stream read")
-                elif oob_op == OOB.EOF:
-                    break
-                idx += oob_sz
-            else:
-                # Flux1
-                val += op
-                flux.append(val)
-                val = 0
-                stream_idx += 1
-                idx += 1
-
-        flux_list += flux
+        index_list, flux_list = decode_stream(dat)
 
         # Crop partial first revolution.
         if len(index_list) > 1:
             short_index, index_list = index_list[0], index_list[1:]
-            flux = 0
-            for i in range(len(flux_list)):
-                if flux >= short_index:
-                    break
-                flux += flux_list[i]
-            flux_list = flux_list[i:]
+            to_index = np.cumsum(flux_list) - flux_list
+            i = np.searchsorted(to_index, short_index)
+            flux_list = flux_list[min(i, len(flux_list)-1):]
 
         return Flux(index_list, flux_list, sck)
 
@@ -5,7 +5,9 @@
 # This is free and unencumbered software released into the public domain.
 # See the file COPYING for more details, or visit <http://unlicense.org>.
 
-import struct, functools
+import struct, functools, mmap
+
+import numpy as np
 
 from .. import error
 from ..flux import Flux
@@ -72,6 +74,25 @@ class SCPOpts:
                 raise error.Fatal("Bad SCP disktype: '%s'" % disktype)
 
 
+def decode_flux(dat):
+    """Decodes SCP 16-bit big-endian flux samples into an array of flux
+    times. Each zero sample adds 65536 ticks to the next non-zero sample.
+    """
+    x = np.frombuffer(dat, dtype='>u2', count=len(dat)//2).astype(np.int64)
+    # Count the overflow samples preceding each real flux sample.
+    nz = np.flatnonzero(x)
+    ovl = np.diff(nz, prepend=-1) - 1
+    return x[nz] + ovl * 65536
+
+
+def decode_index(tdh):
+    """Extracts the per-revolution index times from an SCP Track Data
+    Header (with the 'TRK' prefix already removed).
+    """
+    tdh = np.frombuffer(tdh, dtype='<u4', count=len(tdh)//4)
+    return tdh.reshape(-1, 3)[:,0].astype(np.int64)
+
+
 class SCPTrack:
 
     def __init__(self, tdh, dat, splice=None):
@@ -91,6 +112,14 @@ class SCP(Image):
         self.nr_revs = None
         self.to_track = dict()
         self.index_cued = True
+        self.lazy_name = None
+
+
+    def __reduce_ex__(self, protocol):
+        # A memory-mapped image cannot be pickled: map it again instead.
+        if self.lazy_name is not None:
+            return (type(self).from_file, (self.lazy_name, True))
+        return super().__reduce_ex__(protocol)
 
     
     def side_count(self):
@@ -101,12 +130,20 @@ class SCP(Image):
 
 
     @classmethod
-    def from_file(cls, name):
+    def from_file(cls, name, lazy=False):
+        """Opens an SCP image. If @lazy is set, the image is memory-mapped
+        and only the TLUT and track headers are parsed up front: track data
+        remains zero-copy views into the mapping until get_track().
+        """
 
         splices = None
 
         with open(name, "rb") as f:
-            dat = f.read()
+            if lazy:
+                dat = memoryview(mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ))
+            else:
+                dat = f.read()
 
         header = struct.unpack("<3s9BI", dat[0:16])
         sig, _, disk_type, nr_revs, _, _, flags, _, single_sided, _, _ = header
@@ -151,6 +188,8 @@ class SCP(Image):
                 pos += chk_len
 
         scp = cls()
+        if lazy:
+            scp.lazy_name = name
 
         for trknr in range(len(trk_offs)):
             
@@ -159,7 +198,7 @@ class SCP(Image):
                 continue
 
             # Parse the SCP track header and extract the flux data.
-            thdr = dat[trk_off:trk_off+4+12*nr_revs]
+            thdr = bytes(dat[trk_off:trk_off+4+12*nr_revs])
             sig, tnr = struct.unpack("<3sB", thdr[:4])
             error.check(sig == b"TRK", "SCP: Missing track signature")
             error.check(tnr == trknr, "SCP: Wrong track number in header")
@@ -215,29 +254,22 @@ class SCP(Image):
         return scp
 
 
+    def track_map(self):
+        return sorted(divmod(tnr, 2) for tnr in self.to_track)
+
+
+    def has_track(self, cyl, side):
+        return cyl * 2 + side in self.to_track
+
+
     def get_track(self, cyl, side):
         tracknr = cyl * 2 + side
         if not tracknr in self.to_track:
             return None
         track = self.to_track[tracknr]
-        tdh, dat = track.tdh, track.dat
-
-        index_list = []
-        while tdh:
-            ticks, _, _ = struct.unpack("<3I", tdh[:12])
-            index_list.append(ticks)
-            tdh = tdh[12:]
-        
-        # Decode the SCP flux data into a simple list of flux times.
-        flux_list = []
-        val = 0
-        for i in range(0, len(dat), 2):
-            x = dat[i]*256 + dat[i+1]
-            if x == 0:
-                val += 65536
-                continue
-            flux_list.append(val + x)
-            val = 0
+        # Decode the SCP flux data into an array of flux times.
+        index_list = decode_index(track.tdh)
+        flux_list = decode_flux(track.dat)
 
         flux = Flux(index_list, flux_list, SCP.sample_freq)
         flux.splice = track.splice if track.splice is not None else 0
@@ -8,21 +8,79 @@ This can warp an image from linear to polar.
 
 It is not quite the inverse of the skimage polar mapping, but it performs the
 task needed for fluxvis
+
+scipy and scikit-image are slow to import, so they are only imported by the
+functions that use them.
 """
 
+from collections import OrderedDict
+
 import numpy as np
 
-from skimage import data
-from skimage.transform import warp
 
+def _source_coords(rows, cols, center, k_radius, k_angle):
+    """Compute the source (row, col) of the given output rows and columns"""
+    yy = np.asarray(cols, dtype=np.float64)[np.newaxis, :] - center[0]
+    xx = np.asarray(rows, dtype=np.float64)[:, np.newaxis] - center[1]
+    return np.hypot(yy, xx) * k_radius, (np.pi + np.arctan2(-yy, xx)) * k_angle
+
+
+def _geometry(output_shape, center, radius):
+    """Fill in the default output shape, center and radius"""
+    if output_shape is None:
+        output_shape = np.array((960, 960))
+    else:
+        output_shape = np.array(output_shape[:2])
+
+    if center is None:
+        center = (output_shape[:2] / 2) - 0.5
+
+    if radius is None:
+        width, height = output_shape[:2] / 2
+        radius = np.hypot(width, height) / np.sqrt(2)
+
+    return output_shape, center, radius
+
+
+# Recently used coordinates, limited by their total size so that large
+# warps are not kept alive after they are done
+COORDS_CACHE_BYTES = 256 << 20
+_coords_cache = OrderedDict()
+
+
+def inverse_polar_coords(output_shape, input_shape, center, radius):
+    """Compute the source coordinates of each output pixel of an inverse polar
+    mapping, in the form accepted by ``warp``
+
+    The result depends only on the geometry, so it is cached (and made
+    read-only) for reuse across images and channels, as long as the cache
+    stays within ``COORDS_CACHE_BYTES``.  Each entry holds two float64 values
+    per output pixel, so warps of more than 4096 pixels square (after
+    oversampling) are not cached."""
+    key = output_shape, input_shape, center, radius
+    if key in _coords_cache:
+        _coords_cache.move_to_end(key)
+        return _coords_cache[key]
+
+    height, width = input_shape
+    k_radius = height / radius
+    k_angle = (width - 1) / (2 * np.pi)
+
+    coords = np.empty((2, *output_shape))
+    coords[0], coords[1] = _source_coords(
+        np.arange(output_shape[0]),
+        np.arange(output_shape[1]),
+        center,
+        k_radius,
+        k_angle,
+    )
+    coords.flags.writeable = False
 
-def _inverse_polar_mapping(output_coords, k_angle, k_radius, center):
-    """Compute an inverse polar mapping"""
-    yy = output_coords[:, 0] - center[0]
-    xx = output_coords[:, 1] - center[1]
-    cc = (np.pi + np.arctan2(-yy, xx)) * k_angle
-    rr = np.hypot(yy, xx) * k_radius
-    return np.column_stack((cc, rr))
+    if coords.nbytes <= COORDS_CACHE_BYTES:
+        _coords_cache[key] = coords
+        while sum(c.nbytes for c in _coords_cache.values()) > COORDS_CACHE_BYTES:
+            _coords_cache.popitem(last=False)
+    return coords
 
 
 def warp_inverse_polar(
@@ -43,39 +101,133 @@ def warp_inverse_polar(
             " got {}".format(image.ndim)
         )
 
-    if output_shape is None:
-        output_shape = np.array((960, 960))
-    else:
-        output_shape = np.array(output_shape[:2])
+    from skimage.transform import warp
 
+    output_shape, center, radius = _geometry(output_shape, center, radius)
     input_shape = np.array(image.shape)[:2]
-    if center is None:
-        center = (output_shape[:2] / 2) - 0.5
 
-    if radius is None:
-        width, height = output_shape[:2] / 2
-        radius = np.hypot(width, height) / np.sqrt(2)
+    coords = inverse_polar_coords(
+        tuple(int(x) for x in output_shape),
+        tuple(int(x) for x in input_shape),
+        tuple(float(x) for x in center),
+        float(radius),
+    )
+    if multichannel:
+        warped = np.dstack(
+            [
+                warp(image[..., channel], coords, output_shape=output_shape, **kwargs)
+                for channel in range(image.shape[2])
+            ]
+        )
+    else:
+        warped = warp(image, coords, output_shape=output_shape, **kwargs)
+
+    return warped
+
 
-    height = input_shape[0]
-    width = input_shape[1]
+def lookup_inverse_polar(
+    image, center=None, *, radius=None, output_shape=None, out=None
+):
+    """Warp an image from linear to polar by nearest-neighbor lookup
+
+    This uses the same geometry as ``warp_inverse_polar``, but keeps the dtype
+    of the image and computes the mapping a band of output rows at a time,
+    so it suits planes of small integers such as palette indices.  Output
+    pixels outside the image are 0.  The result is written to ``out`` if
+    given, which must be zeroed."""
+    if image.ndim != 2:
+        raise ValueError("Input array must be 2 dimensions, got {}".format(image.ndim))
+
+    output_shape, center, radius = _geometry(output_shape, center, radius)
+    height, width = image.shape
+    k_radius = height / radius
+    k_angle = (width - 1) / (2 * np.pi)
 
+    rows, cols = (int(x) for x in output_shape)
+    result = np.zeros((rows, cols), dtype=image.dtype) if out is None else out
+    band = max(1, (1 << 20) // cols)
+    for i in range(0, rows, band):
+        row, col = _source_coords(
+            np.arange(i, min(i + band, rows)),
+            np.arange(cols),
+            center,
+            k_radius,
+            k_angle,
+        )
+        row = np.rint(row).astype(np.intp)
+        col = np.rint(col).astype(np.intp)
+        inside = row < height
+        result[i : i + band][inside] = image[row[inside], col[inside]]
+    return result
+
+
+def inverse_polar_tile(image, rows, cols, *, output_shape, oversample=1):
+    """Warp one rectangle of the output of an inverse polar mapping
+
+    The output ``rows`` and ``cols`` ranges are warped at ``oversample``
+    times the output resolution, then scaled back down, exactly as
+    ``warp_inverse_polar`` followed by ``downscale_local_mean`` would.  Only
+    the band of source rows and columns the tile needs is read from the
+    image, so it may be a ``np.memmap`` much larger than memory."""
+    if image.ndim != 2:
+        raise ValueError("Input array must be 2 dimensions, got {}".format(image.ndim))
+
+    _, center, radius = _geometry(
+        (output_shape[0] * oversample, output_shape[1] * oversample), None, None
+    )
+    height, width = image.shape
     k_radius = height / radius
     k_angle = (width - 1) / (2 * np.pi)
 
-    warp_args = {"k_angle": k_angle, "k_radius": k_radius, "center": center}
-    warped = warp(
-        image,
-        _inverse_polar_mapping,
-        map_args=warp_args,
-        output_shape=output_shape,
-        **kwargs,
+    coords = np.array(
+        _source_coords(
+            np.arange(rows.start * oversample, rows.stop * oversample),
+            np.arange(cols.start * oversample, cols.stop * oversample),
+            center,
+            k_radius,
+            k_angle,
+        )
     )
 
-    return warped
+    # Read just the source band under this tile, with a margin for
+    # interpolation; tiles within the disc center read every column
+    lo = np.maximum(np.floor(coords.min(axis=(1, 2))).astype(int) - 1, 0)
+    hi = np.minimum(np.ceil(coords.max(axis=(1, 2))).astype(int) + 2, (height, width))
+    if lo[0] >= hi[0]:
+        return np.zeros((len(rows), len(cols)), np.float32)
+    coords -= lo[:, np.newaxis, np.newaxis]
+    band = np.asarray(image[lo[0] : hi[0], lo[1] : hi[1]])
+    from scipy.ndimage import map_coordinates
+    from skimage.transform import downscale_local_mean
+
+    warped = map_coordinates(band, coords, order=1, mode="grid-constant", cval=0)
+    return downscale_local_mean(warped, (oversample, oversample))
+
+
+def iter_inverse_polar_tiles(image, *, output_shape, tile, oversample=1):
+    """Warp an image from linear to polar one square tile at a time with
+    ``inverse_polar_tile``
+
+    Yields the output row, column and pixels of each tile in turn."""
+    rows, cols = (int(x) for x in output_shape[:2])
+    for row0 in range(0, rows, tile):
+        for col0 in range(0, cols, tile):
+            yield (
+                row0,
+                col0,
+                inverse_polar_tile(
+                    image,
+                    range(row0, min(row0 + tile, rows)),
+                    range(col0, min(col0 + tile, cols)),
+                    output_shape=(rows, cols),
+                    oversample=oversample,
+                ),
+            )
 
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
+    from skimage import data
 
     checkerboard = data.checkerboard()
 
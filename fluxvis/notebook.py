@@ -4,6 +4,7 @@
 
 """Helper function for use in Jupyter Notebook"""
 
+import hashlib
 import io
 import os
 import tempfile
@@ -12,13 +13,18 @@ from ipywidgets import FileUpload
 from IPython.display import display
 import matplotlib.pyplot as plt
 from . import open_flux, process
+from .fluxcache import DensityCache
+
+# Linear images of recent uploads, so that re-running go() with only the
+# image size or style changed does not render the tracks again
+density_cache = DensityCache()
 
 
 def go(
     side=0,
-    tracks=35,
+    tracks=None,
     start=0,
-    stride=4,
+    stride=None,
     linear=False,
     slices=800,
     stacks=3,
@@ -43,12 +49,16 @@ def go(
             uploader._counter = 0
 
     def process_one_flux(filename, content):
-        with io.BytesIO(content) as b, tempfile.NamedTemporaryFile(
-            suffix=os.path.splitext(filename)[1]
-        ) as t:
-            shutil.copyfileobj(b, t)
-            t.flush()
-            flux = open_flux(t.name)
+        key = hashlib.blake2b(content).hexdigest()
+        if filename.lower().endswith(".a2r"):
+            flux = open_flux(filename, key=key, data=content)
+        else:
+            with io.BytesIO(content) as b, tempfile.NamedTemporaryFile(
+                suffix=os.path.splitext(filename)[1]
+            ) as t:
+                shutil.copyfileobj(b, t)
+                t.flush()
+                flux = open_flux(t.name, key=key)
         density = process(
             flux,
             side=side,
@@ -62,6 +72,7 @@ def go(
             diameter=diameter,
             resolution=resolution,
             oversample=oversample,
+            density_cache=density_cache,
         )
 
         fig, axis = plt.subplots()
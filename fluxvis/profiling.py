@@ -0,0 +1,132 @@
+# SPDX-FileCopyrightText: 2022 Jeff Epler for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""Record the time and memory taken by each stage of rendering
+
+Pass a ``Profile`` to ``process`` to record each stage, and each track as it
+is histogrammed, with its wall and CPU time, the peak resident memory of the
+process at its end, and counts such as the flux it handled or the bytes it
+produced.  Without one, ``NULL_PROFILE`` is used, which records nothing and
+costs no more than a function call per stage or track.
+
+Tracks histogrammed by worker processes (with ``jobs``) are not recorded
+individually.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def peak_rss():
+    """The peak resident memory of this process in bytes, or None if it
+    cannot be found"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profile:
+    """Record stages and tracks, calling ``callback`` (if given) with each
+    event as it is recorded"""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = []
+        self.tracks = []
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def _measure(self, events, event):
+        counts = {}
+        start = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield counts
+        finally:
+            event.update(
+                start=start - self._origin,
+                wall=time.perf_counter() - start,
+                cpu=time.process_time() - cpu,
+                peak_rss=peak_rss(),
+                **counts,
+            )
+            events.append(event)
+            if self.callback is not None:
+                self.callback(event)
+
+    def stage(self, name):
+        """Measure a stage of rendering
+
+        The context manager gives a dict, in which the stage may record
+        counts such as "flux" or "bytes"."""
+        return self._measure(self.stages, {"name": name})
+
+    def track(self, cyl, side):
+        """Measure reading and histogramming a track, as for ``stage``"""
+        return self._measure(
+            self.tracks, {"name": f"track {cyl}.{side}", "cyl": cyl, "side": side}
+        )
+
+    def to_json(self):
+        """The events recorded, as a JSON-serializable dict"""
+        return {"stages": self.stages, "tracks": self.tracks}
+
+    def to_chrome_trace(self):
+        """The events recorded, in the Chrome trace event format, with times
+        in microseconds"""
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": event["name"],
+                    "ph": "X",
+                    "ts": event["start"] * 1e6,
+                    "dur": event["wall"] * 1e6,
+                    "pid": pid,
+                    "tid": 0,
+                    "args": {
+                        key: value
+                        for key, value in event.items()
+                        if key not in ("name", "start", "wall")
+                    },
+                }
+                for event in self.stages + self.tracks
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def write(self, filename, fmt="json"):
+        """Write the events recorded to a file, as "json" or "chrome" trace
+        events"""
+        data = self.to_chrome_trace() if fmt == "chrome" else self.to_json()
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+
+
+class NullProfile:
+    """A profile which records nothing, for when profiling is off
+
+    Each stage or track is given a fresh dict for its counts, which is
+    dropped when it ends."""
+
+    def stage(self, name):
+        """Measure nothing"""
+        return contextlib.nullcontext({})
+
+    def track(self, cyl, side):
+        """Measure nothing"""
+        return contextlib.nullcontext({})
+
+
+NULL_PROFILE = NullProfile()
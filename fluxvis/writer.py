@@ -0,0 +1,251 @@
+# SPDX-FileCopyrightText: 2022 Jeff Epler for Adafruit Industries
+#
+# SPDX-License-Identifier: MIT
+
+"""Write images a band of rows at a time
+
+PNG and TIFF files are encoded as the rows arrive, so that an image need not
+be in memory all at once (it may be a ``np.memmap``).  Other formats are left
+to scikit-image.
+"""
+
+import os
+import struct
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# TIFF field types and tags
+SHORT = 3
+LONG = 4
+LONG8 = 16
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+
+COMPRESSION_DEFLATE = 8
+PHOTOMETRIC_MINISBLACK = 1
+PHOTOMETRIC_RGB = 2
+
+
+class _RowWriter:
+    """Common parts of the streaming image writers"""
+
+    def __init__(self, filename, width, height, channels):
+        if channels not in (1, 3):
+            raise ValueError(f"Only 1 or 3 channel images supported, got {channels}")
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.rows = 0
+        self._file = open(filename, "wb")
+
+    def write(self, rows):
+        """Write the next rows of the image, as an 8-bit array of shape
+        (n, width) or (n, width, channels)"""
+        rows = np.ascontiguousarray(rows, dtype=np.uint8)
+        rows = rows.reshape(len(rows), -1)
+        if rows.shape[1] != self.width * self.channels:
+            raise ValueError(
+                f"Expected rows of {self.width}x{self.channels} pixels, "
+                f"got {rows.shape[1]} values"
+            )
+        if self.rows + len(rows) > self.height:
+            raise ValueError(f"Image only has {self.height} rows")
+        self.rows += len(rows)
+        self._write(rows)
+
+    def close(self):
+        """Finish the image and close the file"""
+        if self._file.closed:
+            return
+        try:
+            if self.rows != self.height:
+                raise ValueError(f"Wrote {self.rows} of {self.height} rows")
+            self._close()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def _write(self, rows):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class PNGWriter(_RowWriter):
+    """Encode an 8-bit grayscale or RGB PNG file as its rows arrive"""
+
+    def __init__(self, filename, width, height, channels=1):
+        super().__init__(filename, width, height, channels)
+        self._compressor = zlib.compressobj()
+        self._pending = []
+        self._pending_size = 0
+        self._file.write(PNG_SIGNATURE)
+        color_type = 0 if channels == 1 else 2
+        self._chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+        )
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def _compressed(self, data):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= 1 << 20:
+            self._chunk(b"IDAT", b"".join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _write(self, rows):
+        # Each row is preceded by its filter type, 0 for none
+        filtered = np.zeros((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        self._compressed(self._compressor.compress(filtered.tobytes()))
+
+    def _close(self):
+        self._pending.append(self._compressor.flush())
+        self._chunk(b"IDAT", b"".join(self._pending))
+        self._chunk(b"IEND", b"")
+
+
+class TIFFWriter(_RowWriter):
+    """Encode an 8-bit grayscale or RGB TIFF file, in deflated strips, as its
+    rows arrive
+
+    A BigTIFF file is written if ``bigtiff`` is true, or if it is None and the
+    image could be too big for the 4GiB limit of a classic TIFF file."""
+
+    def __init__(self, filename, width, height, channels=1, bigtiff=None):
+        super().__init__(filename, width, height, channels)
+        row_size = width * channels
+        if bigtiff is None:
+            bigtiff = row_size * height > (1 << 32) - (1 << 26)
+        self.bigtiff = bigtiff
+        self.rows_per_strip = max(1, min(height, (1 << 20) // row_size))
+        self._pending = []
+        self._pending_rows = 0
+        self._offsets = []
+        self._sizes = []
+        if bigtiff:
+            self._file.write(struct.pack("<2sHHHQ", b"II", 43, 8, 0, 0))
+        else:
+            self._file.write(struct.pack("<2sHI", b"II", 42, 0))
+
+    def _strip(self, rows):
+        data = zlib.compress(rows.tobytes())
+        self._offsets.append(self._file.tell())
+        self._sizes.append(len(data))
+        self._file.write(data)
+        if len(data) % 2:
+            self._file.write(b"\0")
+
+    def _write(self, rows):
+        self._pending.append(rows)
+        self._pending_rows += len(rows)
+        if self._pending_rows < self.rows_per_strip:
+            return
+        rows = np.concatenate(self._pending)
+        whole = len(rows) - len(rows) % self.rows_per_strip
+        for i in range(0, whole, self.rows_per_strip):
+            self._strip(rows[i : i + self.rows_per_strip])
+        self._pending = [rows[whole:]]
+        self._pending_rows = len(rows) - whole
+
+    def _close(self):
+        if self._pending_rows:
+            self._strip(np.concatenate(self._pending))
+
+        offset_type = LONG8 if self.bigtiff else LONG
+        tags = [
+            (IMAGE_WIDTH, LONG, [self.width]),
+            (IMAGE_LENGTH, LONG, [self.height]),
+            (BITS_PER_SAMPLE, SHORT, [8] * self.channels),
+            (COMPRESSION, SHORT, [COMPRESSION_DEFLATE]),
+            (
+                PHOTOMETRIC,
+                SHORT,
+                [PHOTOMETRIC_MINISBLACK if self.channels == 1 else PHOTOMETRIC_RGB],
+            ),
+            (STRIP_OFFSETS, offset_type, self._offsets),
+            (SAMPLES_PER_PIXEL, SHORT, [self.channels]),
+            (ROWS_PER_STRIP, LONG, [self.rows_per_strip]),
+            (STRIP_BYTE_COUNTS, offset_type, self._sizes),
+            (PLANAR_CONFIGURATION, SHORT, [1]),
+        ]
+
+        if self.bigtiff:
+            count_format, entry_format, value_size = "<Q", "<HHQ", 8
+        else:
+            count_format, entry_format, value_size = "<H", "<HHI", 4
+        offset_format = "<Q" if self.bigtiff else "<I"
+        value_format = {SHORT: "H", LONG: "I", LONG8: "Q"}
+
+        # Values too big to fit in their entry follow the directory
+        ifd_offset = self._file.tell()
+        ifd_size = (
+            struct.calcsize(count_format)
+            + len(tags) * (struct.calcsize(entry_format) + value_size)
+            + struct.calcsize(offset_format)
+        )
+        entries = [struct.pack(count_format, len(tags))]
+        extra = []
+        extra_offset = ifd_offset + ifd_size
+        for tag, kind, values in tags:
+            data = struct.pack(f"<{len(values)}{value_format[kind]}", *values)
+            entries.append(struct.pack(entry_format, tag, kind, len(values)))
+            if len(data) <= value_size:
+                entries.append(data.ljust(value_size, b"\0"))
+            else:
+                entries.append(struct.pack(offset_format, extra_offset))
+                extra.append(data)
+                extra_offset += len(data)
+        entries.append(struct.pack(offset_format, 0))
+
+        self._file.write(b"".join(entries + extra))
+        self._file.seek(8 if self.bigtiff else 4)
+        self._file.write(struct.pack(offset_format, ifd_offset))
+
+
+WRITERS = {".png": PNGWriter, ".tif": TIFFWriter, ".tiff": TIFFWriter}
+
+
+def write_image(filename, image):
+    """Write an 8-bit grayscale or RGB image to a file, a band of rows at a
+    time if the format allows"""
+    writer = WRITERS.get(os.path.splitext(filename)[1].lower())
+    if writer is None:
+        from skimage.io import imsave
+
+        imsave(filename, image)
+        return
+
+    height, width = image.shape[:2]
+    channels = image.shape[2] if image.ndim == 3 else 1
+    band = max(1, (1 << 22) // (width * channels))
+    with writer(filename, width, height, channels) as output:
+        for i in range(0, height, band):
+            output.write(image[i : i + band])